@@ -0,0 +1,369 @@
+# insightlink_benchmark.py
+# Headless load test for the teacher's streaming server
+# App Name: InsightLink v1.0
+#
+# Runs ScreenSharingServer without Tk on a synthetic screen, connects a swarm of simulated students over
+# loopback and prints a JSON report, e.g.:
+#   python insightlink_benchmark.py --source scroll --clients 1,4,16 --duration 10 --output results.json
+# or, without a server, compares bytes and quality of JPEG-only against hybrid tiles on one screen:
+#   python insightlink_benchmark.py --compare-codecs --source mixed --images screenshot.png
+
+import socket, threading, struct, io, time, sys, os, json, zlib, math, argparse, contextlib, multiprocessing
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageFont
+import insightlink_teacher as teacher
+
+# --- Benchmark Configuration ---
+DEFAULT_SIZE = (1920, 1080)
+WARMUP_SECONDS = 2.0 # Ignored at the start of every run while connections settle and renditions are created
+SLIDE_SECONDS = 3.0 # How long each synthetic slide stays on screen
+SCROLL_STEP = 8 # Pixels the synthetic text scrolls per grab
+CONNECT_TIMEOUT = 5.0
+
+# --- Synthetic Screens ---
+class SlidesSource:
+    """A slide deck: a handful of static slides, switching every SLIDE_SECONDS. The common classroom case."""
+    def __init__(self, size=DEFAULT_SIZE, count=5):
+        self.slides = []
+        font = ImageFont.load_default()
+        for index in range(count):
+            slide = Image.new("RGB", size, (250, 250, 250))
+            draw = ImageDraw.Draw(slide)
+            draw.rectangle((0, 0, size[0], size[1] // 8), fill=(41, 110, 72))
+            draw.text((40, size[1] // 24), f"Slide {index + 1}: Benchmark Content", fill=(255, 255, 255), font=font)
+            for line in range(12):
+                draw.text((80, size[1] // 5 + line * 40), f"- Bullet point {line + 1} on slide {index + 1}", fill=(30, 30, 30), font=font)
+            draw.ellipse((size[0] * 2 // 3, size[1] // 3, size[0] - 80, size[1] - 80), fill=(240, 148, 46))
+            self.slides.append(slide)
+        self.started = time.time()
+
+    def grab(self):
+        return self.slides[int((time.time() - self.started) / SLIDE_SECONDS) % len(self.slides)]
+
+    def close(self):
+        pass
+
+class ScrollingTextSource:
+    """A document or code editor being scrolled: most of the screen changes, but it is all text."""
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        font = ImageFont.load_default()
+        self.page = Image.new("RGB", (size[0], size[1] * 3), (255, 255, 255))
+        draw = ImageDraw.Draw(self.page)
+        for line in range(self.page.height // 20):
+            draw.text((20, line * 20), f"{line:5d}  def handle_line_{line}(data): return process(data[{line}:]) # scrolling text",
+                      fill=(20, 20, 20), font=font)
+        self.offset = 0
+
+    def grab(self):
+        self.offset = (self.offset + SCROLL_STEP) % (self.page.height - self.size[1])
+        return self.page.crop((0, self.offset, self.size[0], self.offset + self.size[1]))
+
+    def close(self):
+        pass
+
+class NoiseSource:
+    """Full-motion worst case: every pixel changes on every grab and nothing compresses well."""
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+
+    def grab(self):
+        return Image.frombytes("RGB", self.size, os.urandom(self.size[0] * self.size[1] * 3))
+
+    def close(self):
+        pass
+
+class MixedSource:
+    """An editor beside a photo: text and photographic content on one static screen."""
+    def __init__(self, size=DEFAULT_SIZE):
+        font = ImageFont.load_default()
+        self.screen = Image.new("RGB", size, (255, 255, 255))
+        draw = ImageDraw.Draw(self.screen)
+        for line in range(size[1] // 20):
+            draw.text((20, line * 20), f"{line:4d}  result = transform(samples[{line}], scale=0.{line % 10})", fill=(20, 20, 20), font=font)
+        photo_box = (size[0] // 2, 0, size[0], size[1])
+        photo = Image.effect_mandelbrot((photo_box[2] - photo_box[0], photo_box[3]), (-0.7454, 0.1130, -0.7452, 0.1132), 256)
+        photo = Image.merge("RGB", (photo, photo.point(lambda value: value * 3 // 4), Image.effect_noise(photo.size, 24)))
+        self.screen.paste(photo.filter(ImageFilter.GaussianBlur(1)), photo_box[:2])
+
+    def grab(self):
+        return self.screen
+
+    def close(self):
+        pass
+
+FRAME_SOURCES = {"slides": SlidesSource, "scroll": ScrollingTextSource, "noise": NoiseSource, "mixed": MixedSource}
+
+# --- Headless Server ---
+class HeadlessApp:
+    """Stands in for TeacherApp: takes the server's UI callbacks without Tk. Per-student stats are in server.roster."""
+    def __init__(self):
+        self.status = ""
+        self.errors = []
+
+    def update_status(self, text): self.status = text
+    def show_error(self, title, msg): self.errors.append(f"{title}: {msg}")
+
+# --- Simulated Students ---
+def recv_exact(sock, view):
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count: return False
+        received += count
+    return True
+
+def decode_image(data, codec, size):
+    if codec == teacher.CODEC_ZLIB_RAW:
+        return Image.frombytes("RGB", size, zlib.decompress(data))
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+def decode_message(msg_type, message):
+    """Decodes a frame the way the student app does, for runs that should include student-side CPU."""
+    if msg_type == teacher.MSG_TILES:
+        tile_count = teacher.TILE_FRAME_HEADER.unpack_from(message)[5]
+        offset = teacher.TILE_FRAME_HEADER.size
+        for _ in range(tile_count):
+            _, _, width, height, codec, length = teacher.TILE_HEADER.unpack_from(message, offset)
+            offset += teacher.TILE_HEADER.size
+            decode_image(message[offset:offset + length], codec, (width, height))
+            offset += length
+    elif msg_type == teacher.MSG_FRAME:
+        codec, _, width, height, _ = teacher.FRAME_HEADER.unpack_from(message)
+        decode_image(message[teacher.FRAME_HEADER.size:], codec, (width, height))
+    elif msg_type is None: # v1: a bare JPEG
+        Image.open(io.BytesIO(message)).load()
+
+def simulated_student(host, port, stop_at, decode, codecs, viewer, results):
+    """One student: speaks v2 like the real client (or v1 when codecs is 0), optionally decoding and acking every message."""
+    arrivals, sizes = [], []
+    try:
+        sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        sock.settimeout(max(0.1, stop_at - time.time()))
+        if codecs:
+            hello = teacher.HELLO.pack(teacher.HELLO_MAGIC, teacher.PROTOCOL_VERSION, codecs, *viewer, 0, 0)
+            sock.sendall(teacher.CLIENT_MESSAGE.pack(teacher.CLIENT_MSG_HELLO, len(hello)) + hello)
+        header = bytearray(teacher.MESSAGE_HEADER.size if codecs else 8)
+        buffer = bytearray(teacher.MAX_IMAGE_SIZE)
+        while time.time() < stop_at:
+            if not recv_exact(sock, memoryview(header)): break
+            msg_type, size = teacher.MESSAGE_HEADER.unpack(header) if codecs else (None, struct.unpack(">Q", header)[0])
+            if size > teacher.MAX_IMAGE_SIZE or not recv_exact(sock, memoryview(buffer)[:size]): break
+            if msg_type in (teacher.MSG_WELCOME, teacher.MSG_CURSOR):
+                continue # Neither is part of the acked frame sequence
+            if decode:
+                decode_message(msg_type, bytes(buffer[:size]))
+            arrivals.append(time.time())
+            sizes.append(size + len(header))
+            if codecs:
+                sock.sendall(teacher.CLIENT_MESSAGE.pack(teacher.CLIENT_MSG_ACK, len(arrivals)))
+        sock.close()
+    except OSError:
+        pass # Timed out at the end of the run, or the server went away
+    results.append({"arrivals": arrivals, "sizes": sizes})
+
+def run_swarm(host, port, clients, stop_at, decode, codecs, viewer, queue):
+    """Runs every simulated student of one run in this (child) process so their CPU isn't billed to the teacher."""
+    results = []
+    threads = [threading.Thread(target=simulated_student, args=(host, port, stop_at, decode, codecs, viewer, results), daemon=True)
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.put(results)
+
+# --- Measurement ---
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def process_rss_mb():
+    """Current resident set size of this process in MB, or the peak where only that is available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+    except ImportError:
+        return None
+
+def run_once(args, clients):
+    """Streams to `clients` simulated students for one measurement window and returns that run's results."""
+    app = HeadlessApp()
+    server = teacher.ScreenSharingServer(app, frame_source=lambda: FRAME_SOURCES[args.source](args.size))
+    if not server.start(args.profile, delta_mode=not args.plain):
+        raise RuntimeError("; ".join(app.errors) or "server failed to start")
+
+    start = time.time()
+    measure_from, stop_at = start + WARMUP_SECONDS, start + WARMUP_SECONDS + args.duration
+    context = multiprocessing.get_context("spawn") # Never fork a process that already runs the server's threads
+    queue = context.Queue()
+    swarm = context.Process(target=run_swarm, args=("127.0.0.1", teacher.PORT, clients, stop_at, args.decode, student_codecs(args), args.viewer or (0, 0), queue))
+    swarm.start()
+
+    time.sleep(max(0, measure_from - time.time()))
+    cpu_start, wall_start = time.process_time(), time.time()
+    grabs_start, changes_start = server.capture_scheduler.grabs, server.capture_scheduler.changes
+    with server.clients_lock:
+        for session in server.clients.values():
+            session.controller.latency_samples.clear() # Drop warm-up samples
+    time.sleep(max(0, stop_at - time.time()))
+    cpu_percent = 100 * (time.process_time() - cpu_start) / (time.time() - wall_start)
+    rss_mb = process_rss_mb()
+    grabs, changes = server.capture_scheduler.grabs - grabs_start, server.capture_scheduler.changes - changes_start
+    with server.clients_lock:
+        latencies = [sample for session in server.clients.values() for sample in session.controller.latency_samples]
+        levels = [session.controller.level for session in server.clients.values()]
+
+    students = queue.get(timeout=WARMUP_SECONDS + CONNECT_TIMEOUT + 30)
+    swarm.join()
+    server.stop()
+
+    fps, frame_bytes = [], []
+    for student in students:
+        window = [size for arrival, size in zip(student["arrivals"], student["sizes"]) if arrival >= measure_from]
+        fps.append(len(window) / args.duration)
+        frame_bytes.extend(window)
+    latency_ms = {name: (None if value is None else round(value * 1000, 1))
+                  for name, value in (("p50", percentile(latencies, 0.5)), ("p90", percentile(latencies, 0.9)),
+                                      ("p99", percentile(latencies, 0.99)), ("max", max(latencies, default=None)))}
+    return {
+        "clients": clients,
+        "connected": len(levels),
+        "fps_per_client": [round(value, 2) for value in fps],
+        "fps_mean": round(sum(fps) / len(fps), 2) if fps else 0.0,
+        "latency_ms": latency_ms,
+        "latency_samples": len(latencies),
+        "bytes_per_frame": round(sum(frame_bytes) / len(frame_bytes)) if frame_bytes else None,
+        "throughput_mbps": round(sum(frame_bytes) * 8 / args.duration / 1e6, 2),
+        "adaptive_levels": levels,
+        "grabs_per_second": round(grabs / args.duration, 2),
+        "changed_grabs_per_second": round(changes / args.duration, 2),
+        "teacher_cpu_percent": round(cpu_percent, 1),
+        "teacher_rss_mb": None if rss_mb is None else round(rss_mb, 1),
+    }
+
+# --- Codec Comparison ---
+def psnr(original, decoded, boxes):
+    """Peak signal-to-noise ratio in dB over the given boxes of two images; None when they are identical there."""
+    squared = pixels = 0
+    for box in boxes:
+        histogram = ImageChops.difference(original.crop(box), decoded.crop(box)).histogram()
+        squared += sum(count * (value % 256) ** 2 for value, count in enumerate(histogram))
+        pixels += (box[2] - box[0]) * (box[3] - box[1])
+    return round(10 * math.log10(255 ** 2 * pixels * 3 / squared), 2) if squared else None
+
+def encode_screen(image, quality, codec):
+    """Encodes one screen as delta-grid tiles, decodes it the way the student composites them; returns (decoded, tiles, ms)."""
+    started = time.perf_counter()
+    tiles = [(box, *teacher.encode_tile(image.crop(box), quality, codec)) for box in teacher.grid_boxes(image.size)]
+    encode_ms = (time.perf_counter() - started) * 1000
+    decoded = Image.new("RGB", image.size)
+    for box, tile_codec, data in tiles:
+        decoded.paste(decode_image(data, tile_codec, (box[2] - box[0], box[3] - box[1])).convert("RGB"), box[:2])
+    return decoded, tiles, encode_ms
+
+def compare_codecs(args):
+    """JPEG-only against hybrid tiles on the synthetic screen and any given screenshots, at the profile's quality.
+
+    Besides the whole screen, quality is reported over the tiles the hybrid codec classified as text, which is
+    where the two differ: JPEG blurs them, hybrid keeps them exact.
+    """
+    quality = teacher.QUALITY_SETTINGS[args.profile]["quality"]
+    screens = [(args.source, FRAME_SOURCES[args.source](args.size).grab().convert("RGB"))]
+    screens += [(path, Image.open(path).convert("RGB")) for path in args.images]
+    results = []
+    for name, image in screens:
+        encoded = {name: encode_screen(image, quality, codec) for name, codec in (("jpeg", teacher.CODEC_JPEG), ("hybrid", teacher.CODEC_HYBRID))}
+        all_boxes = [box for box, _, _ in encoded["hybrid"][1]]
+        text_boxes = [box for box, tile_codec, _ in encoded["hybrid"][1] if tile_codec == teacher.CODEC_ZLIB_RAW]
+        result = {"screen": name, "size": list(image.size), "tiles": len(all_boxes), "text_tiles": len(text_boxes)}
+        for codec_name, (decoded, tiles, encode_ms) in encoded.items():
+            result[codec_name] = {
+                "bytes": sum(len(data) for _, _, data in tiles),
+                "encode_ms": round(encode_ms, 1),
+                "psnr_db": psnr(image, decoded, all_boxes),
+                "text_psnr_db": psnr(image, decoded, text_boxes) if text_boxes else None,
+            }
+        result["hybrid_bytes_ratio"] = round(result["hybrid"]["bytes"] / result["jpeg"]["bytes"], 3)
+        results.append(result)
+    return {"profile": args.profile, "quality": quality, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "screens": results}
+
+def student_codecs(args):
+    """The codec bitmask the simulated students announce; 0 makes them v1 clients that never send a hello."""
+    if args.v1:
+        return 0
+    return {"jpeg": teacher.CODEC_JPEG, "webp": teacher.CODEC_WEBP, "zlib": teacher.CODEC_ZLIB_RAW,
+            "hybrid": teacher.CODEC_HYBRID}.get(args.codec, teacher.TEACHER_CODECS)
+
+def parse_size(text):
+    width, height = (int(part) for part in text.lower().split("x"))
+    return (width, height)
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless InsightLink teacher benchmark with simulated students.")
+    parser.add_argument("--source", choices=sorted(FRAME_SOURCES), default="slides", help="synthetic screen content")
+    parser.add_argument("--size", type=parse_size, default=DEFAULT_SIZE, help="synthetic screen size, e.g. 3840x2160")
+    parser.add_argument("--clients", default="1,4,16", help="comma-separated student counts, one run each")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per run (after warm-up)")
+    parser.add_argument("--profile", choices=list(teacher.QUALITY_SETTINGS), default="High (LAN)")
+    parser.add_argument("--plain", action="store_true", help="stream full JPEG frames instead of tile deltas")
+    parser.add_argument("--decode", action="store_true", help="have simulated students decode every frame")
+    parser.add_argument("--codec", choices=("any", "jpeg", "webp", "zlib", "hybrid"), default="any",
+                        help="only codec the students announce; hybrid announces JPEG and zlib")
+    parser.add_argument("--viewer", type=parse_size, help="stream window size the students announce, e.g. 1366x768 (default: full size)")
+    parser.add_argument("--v1", action="store_true", help="simulate original v1 students (no hello, plain JPEG, no acks)")
+    parser.add_argument("--fixed-capture", action="store_true", help="grab and encode at the profile's fixed rate, without change detection")
+    parser.add_argument("--compare-codecs", action="store_true", help="skip streaming; compare JPEG-only and hybrid tiles on one screen")
+    parser.add_argument("--images", nargs="*", default=[], help="screenshots to include in --compare-codecs")
+    parser.add_argument("--port", type=int, default=teacher.PORT)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    teacher.PORT = args.port
+    teacher.ADAPTIVE_CAPTURE = not args.fixed_capture
+
+    if args.compare_codecs:
+        report = compare_codecs(args)
+    else:
+        report = stream_report(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+def stream_report(args):
+    """Streams to every requested student count in turn and collects the runs into one report."""
+    runs = []
+    with contextlib.redirect_stdout(sys.stderr): # Keep the server's log lines out of the JSON
+        for clients in (int(count) for count in args.clients.split(",")):
+            print(f"[BENCHMARK] {clients} student(s), {args.source} {args.size[0]}x{args.size[1]}, {args.duration:g}s")
+            runs.append(run_once(args, clients))
+    return {
+        "source": args.source,
+        "size": list(args.size),
+        "profile": args.profile,
+        "delta_mode": not args.plain,
+        "student_decode": args.decode,
+        "protocol": 1 if args.v1 else teacher.PROTOCOL_VERSION,
+        "student_codecs": student_codecs(args),
+        "viewer_size": list(args.viewer) if args.viewer else None,
+        "adaptive_capture": not args.fixed_capture,
+        "duration": args.duration,
+        "encode_workers": teacher.ENCODE_WORKERS,
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "runs": runs,
+    }
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,9 @@
 # App Name: InsightLink v1.0
 # Developed by: Zihad Hasan
 
-import socket, threading, struct, io, time, sys, os, re
-from PIL import Image, ImageTk, UnidentifiedImageError
+import socket, threading, struct, io, time, sys, os, re, json, zlib, glob, mmap, bisect, functools, contextlib, collections
+import logging, logging.handlers
+from PIL import Image, ImageDraw, ImageFont, ImageTk, UnidentifiedImageError, features
 import tkinter as tk
 from tkinter import ttk, messagebox
 
@@ -32,6 +33,662 @@ FONT_PRIMARY = "Segoe UI"
 # --- Network Configuration ---
 PORT = 9999
 MAX_IMAGE_SIZE = 10 * 1024 * 1024 # 10 MB limit for incoming images
+TILE_FRAME_MAGIC = b'ILTF'
+TILE_FRAME_HEADER = struct.Struct(">4sBIHHHd") # magic, flags, seq, width, height, tile count, capture timestamp
+TILE_HEADER = struct.Struct(">HHHHBI") # x, y, width, height, codec, data length
+TILE_FLAG_KEYFRAME = 0x01
+FRAME_INFO_MAGIC = b'ILFI'
+FRAME_INFO_SEGMENT = struct.Struct(">HH4sId") # JPEG COM marker, segment length, magic, seq, capture timestamp
+CLIENT_MESSAGE = struct.Struct(">cI") # kind, value
+CLIENT_MSG_ACK = b'A' # value: number of messages handled so far
+CLIENT_MSG_MULTICAST = b'M' # value: 1 once receiving from the multicast group, 0 when falling back to TCP
+CLIENT_MSG_KEYFRAME = b'K' # lost sync; ask the teacher for a keyframe
+CLIENT_MSG_STATS = b'S' # value: size of the STUDENT_STATS record that follows
+CLIENT_MSG_HELLO = b'H' # value: size of the HELLO record that follows; always the first message
+CLIENT_MSG_VIEWPORT = b'V' # value: size of the VIEWPORT record that follows
+CLIENT_MSG_ROSTER = b'R' # value: size of the ROSTER that follows (relays only)
+VIEWPORT = struct.Struct(">HH") # stream window width, height
+VIEWPORT_REPORT_DELAY = 250 # ms; a window drag produces a burst of resizes, only where it settles is reported
+# Capture time of the last frame shown, ms since it was shown, displayed fps, receive/decode/resize/display ms, frames dropped
+STUDENT_STATS = struct.Struct(">dffffffI")
+STATS_REPORT_INTERVAL = 1.0 # Seconds between reports to the teacher
+
+# --- Protocol ---
+# v1 (the original app): every message is a bare ">Q" length followed by a JPEG. v2 opens with our HELLO and the
+# teacher's WELCOME, after which every message starts with a typed MESSAGE_HEADER. An original teacher never
+# answers the hello, so its first ">Q" prefix (whose top byte is always zero) tells the two apart.
+# v3 adds MSG_CURSOR, which is not acked.
+PROTOCOL_VERSION = 3
+HELLO_MAGIC = b'ILHI'
+HELLO = struct.Struct(">4sBBHHHH") # magic, protocol version, codec bitmask, viewer width, viewer height, decode budget (ms per frame), relay port
+MESSAGE_HEADER = struct.Struct(">BI") # message type, body length
+MSG_LEGACY = 0 # Never on the wire: a bare JPEG from a v1 teacher
+MSG_WELCOME = 1
+MSG_FRAME = 2
+MSG_TILES = 3
+MSG_MULTICAST_ANNOUNCE = 4
+MSG_WATERMARK = 5
+MSG_REDIRECT = 6 # REDIRECT body: reconnect to this relay
+MSG_RELAY_WATERMARK = 7 # ROSTER_ENTRY + watermark metadata for one of our viewers (relays only)
+MSG_RELAY_KICK = 8 # ROSTER_ENTRY of one of our viewers to disconnect; a relay passes it on to that viewer before closing
+MSG_KEEPALIVE = 9 # Empty; the teacher's screen is idle
+MSG_CURSOR = 10 # CURSOR body (v3); the only message type that isn't acked
+WELCOME = struct.Struct(">BB") # protocol version, codecs the teacher can send
+FRAME_HEADER = struct.Struct(">BIHHd") # codec, seq, width, height, capture timestamp
+CODEC_JPEG = 0x01
+CODEC_WEBP = 0x02
+CODEC_ZLIB_RAW = 0x04 # zlib-compressed raw RGB; also the teacher's lossless text tiles, mixed in with JPEG ones
+STUDENT_CODECS = CODEC_JPEG | CODEC_ZLIB_RAW | (CODEC_WEBP if features.check("webp") else 0)
+DECODE_BUDGET_MS = int(os.environ.get("INSIGHTLINK_DECODE_BUDGET_MS", 50)) # Decode + resize time per frame before the teacher sends less; 0 = no limit
+MESSAGE_LIMITS = { # Largest body accepted per message type
+    MSG_LEGACY: MAX_IMAGE_SIZE,
+    MSG_WELCOME: WELCOME.size,
+    MSG_FRAME: MAX_IMAGE_SIZE,
+    MSG_TILES: MAX_IMAGE_SIZE,
+    MSG_MULTICAST_ANNOUNCE: 64,
+    MSG_WATERMARK: 4096, # Header plus the watermark text
+    MSG_REDIRECT: 6,
+    MSG_RELAY_WATERMARK: 4096,
+    MSG_RELAY_KICK: 6,
+    MSG_KEEPALIVE: 0,
+    MSG_CURSOR: 5,
+}
+UNKNOWN_MESSAGE_LIMIT = 64 * 1024 # Messages of types added by newer teachers are skipped up to this size
+
+# --- Multicast Broadcast ---
+MULTICAST_INTERFACE = os.environ.get("INSIGHTLINK_MULTICAST_IF", "0.0.0.0") # e.g. 127.0.0.1 to test on one machine
+MULTICAST_PACKET_MAGIC = b'ILMP'
+MULTICAST_PACKET_HEADER = struct.Struct(">4sIIHHB") # magic, broadcast seq, payload length, index, data packet count, kind
+PACKET_KIND_DATA = 0
+PACKET_KIND_PARITY = 1 # index is the FEC group number
+FEC_GROUP_SIZE = 8
+MULTICAST_ANNOUNCE_MAGIC = b'ILMA'
+MULTICAST_ANNOUNCE = struct.Struct(">4s4sH") # magic, group address, port
+WATERMARK_META_MAGIC = b'ILWM'
+WATERMARK_META_HEADER = struct.Struct(">4sHHHB") # magic, x, y, font size, alpha; followed by the UTF-8 text
+MULTICAST_SILENCE_TIMEOUT = 10.0 # Seconds without a datagram before falling back to TCP (an idle teacher sends keepalives every 2s)
+MAX_PENDING_FRAMES = 4 # Incomplete frames held back before the oldest is declared lost
+
+# --- Relay ---
+RELAY_PORT = int(os.environ.get("INSIGHTLINK_RELAY_PORT", 0)) # e.g. 9997 to re-serve the stream to nearby students; 0 = off
+RELAY_CAPACITY = int(os.environ.get("INSIGHTLINK_RELAY_CAPACITY", 8)) # Downstream viewers accepted at most
+RELAY_QUEUE_LIMIT = 8 # Messages queued for one viewer before it is dropped back to the next keyframe
+RELAY_CONNECT_TIMEOUT = 5.0
+RELAY_REJOIN_DELAY = 1.0 # Pause before rejoining the teacher after losing a relay, giving it time to notice the loss too
+RELAY_REJOIN_ATTEMPTS = 5 # Rejoins in a row that may end up at a dead relay again before giving up
+REDIRECT = struct.Struct(">4sH") # relay IPv4 address, port
+ROSTER = struct.Struct(">HH") # capacity, viewer count; followed by one ROSTER_ENTRY per viewer
+ROSTER_ENTRY = struct.Struct(">4sH") # viewer IPv4 address, port
+RELAY_BAND_QUALITY = 90 # JPEG quality of the watermark band a relay stamps into each viewer's stream
+RELAY_BAND_ALIGNMENT = 16 # Band sizes are rounded up to whole JPEG MCUs, as the teacher does
+
+# --- Display Pipeline ---
+DECODE_QUEUE_LIMIT = 3 # Undecoded messages held before the receiver stops reading (and acking) to slow the teacher down
+RECEIVE_BUFFER_MIN = 64 * 1024 # Receive buffers are sized in powers of two from here up to MAX_IMAGE_SIZE
+RECEIVE_POOL_LIMIT = DECODE_QUEUE_LIMIT + 2 # Idle buffers kept for reuse; enough for a full decode queue plus one in flight each way
+DISPLAY_FILTER = Image.Resampling.BILINEAR # Far cheaper than LANCZOS; the difference is invisible on screen text at these ratios
+
+# --- Pointer Overlay ---
+CURSOR = struct.Struct(">HHB") # teacher's pointer x, y in 1/65535ths of the shared screen, shape
+CURSOR_HIDDEN = 0
+CURSOR_SHAPES = { # Outline of each pointer shape in pixels, relative to its hotspot
+    1: (0, 0, 0, 17, 4, 13, 7, 19, 9, 18, 6, 12, 12, 12), # Arrow
+    2: (-4, -9, 4, -9, 4, -7, 1, -7, 1, 7, 4, 7, 4, 9, -4, 9, -4, 7, -1, 7, -1, -7, -4, -7), # I-beam
+    3: (0, 0, 3, 0, 3, 7, 10, 8, 10, 17, 2, 17, -3, 11, -3, 8, 0, 9), # Hand
+    4: (-6, -8, 6, -8, 1, 0, 6, 8, -6, 8, -1, 0), # Busy
+    5: (-1, -8, 1, -8, 1, -1, 8, -1, 8, 1, 1, 1, 1, 8, -1, 8, -1, 1, -8, 1, -8, -1, -1, -1), # Crosshair
+}
+
+# --- Metrics ---
+METRICS_LOG_PATH = os.environ.get("INSIGHTLINK_METRICS_LOG") # e.g. student_metrics.log; one JSON line per second
+METRICS_LOG_MAX_BYTES = 5 * 1024 * 1024
+METRICS_LOG_BACKUPS = 3
+STAGE_SMOOTHING = 0.2 # Weight of the newest sample in the per-stage moving averages
+
+# --- Recording Playback ---
+# Recordings are written by the teacher app: segment files of v2 messages, each with a fixed-size index beside it.
+RECORD_MAGIC = b'ILRC'
+RECORD_HEADER = struct.Struct(">4sBd") # magic, format version, segment start time
+RECORD_INDEX_ENTRY = struct.Struct(">dIB") # capture timestamp, offset of the message in the segment, flags
+RECORD_FLAG_KEYFRAME = 0x01
+RECORD_SUFFIX = ".ilrec"
+RECORD_INDEX_SUFFIX = ".ilidx"
+SEGMENT_NAME_REGEX = re.compile(r"^(.*)-\d+" + re.escape(RECORD_SUFFIX) + "$")
+PLAYBACK_SEEK_STEP = 10.0 # Seconds skipped by the arrow keys
+
+class MulticastReassembler:
+    """Rebuilds frame payloads from multicast datagrams and hands them out strictly in broadcast order.
+
+    One lost datagram per FEC group is repaired from that group's XOR parity; a frame that can't be repaired
+    is reported as lost (None) so the caller can drop its deltas and ask for a keyframe.
+    """
+    def __init__(self):
+        self.pending = {} # broadcast seq -> {"length", "count", "data": {index: bytes}, "parity": {group: bytes}}
+        self.next_seq = None
+
+    def add(self, packet):
+        """Feeds one datagram; returns a list of (seq, payload-or-None) ready to be applied in order."""
+        if len(packet) < MULTICAST_PACKET_HEADER.size:
+            return []
+        magic, seq, length, index, count, kind = MULTICAST_PACKET_HEADER.unpack_from(packet)
+        if magic != MULTICAST_PACKET_MAGIC or length > MAX_IMAGE_SIZE or (self.next_seq is not None and seq < self.next_seq):
+            return []
+        frame = self.pending.setdefault(seq, {"length": length, "count": count, "data": {}, "parity": {}})
+        frame["parity" if kind == PACKET_KIND_PARITY else "data"][index] = packet[MULTICAST_PACKET_HEADER.size:]
+        if self.next_seq is None:
+            self.next_seq = seq
+        return self._drain()
+
+    def _assemble(self, frame):
+        data = frame["data"]
+        for group, parity in frame["parity"].items():
+            members = range(group * FEC_GROUP_SIZE, min((group + 1) * FEC_GROUP_SIZE, frame["count"]))
+            missing = [index for index in members if index not in data]
+            if len(missing) == 1:
+                repaired = int.from_bytes(parity, 'big')
+                for index in members:
+                    if index != missing[0]:
+                        repaired ^= int.from_bytes(data[index].ljust(len(parity), b'\0'), 'big')
+                chunk_length = min(len(parity), frame["length"] - missing[0] * len(parity))
+                data[missing[0]] = repaired.to_bytes(len(parity), 'big')[:chunk_length]
+        if len(data) < frame["count"]:
+            return None
+        return b''.join(data[index] for index in range(frame["count"]))
+
+    def _drain(self):
+        ready = []
+        while self.next_seq in self.pending:
+            payload = self._assemble(self.pending[self.next_seq])
+            if payload is None and len(self.pending) <= MAX_PENDING_FRAMES:
+                break
+            ready.append((self.next_seq, payload)) # None once newer frames have piled up behind it: lost
+            del self.pending[self.next_seq]
+            self.next_seq += 1
+        if self.pending and self.next_seq not in self.pending and len(self.pending) > MAX_PENDING_FRAMES:
+            ready.append((self.next_seq, None)) # Not a single datagram of this frame arrived
+            self.next_seq = min(self.pending)
+            ready.extend(self._drain())
+        return ready
+
+class RelayViewer:
+    """One downstream student of a relay: a bounded outgoing queue drained by its own sender thread."""
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.synced = False # Deltas are useless until the viewer has had a keyframe
+        self.closed = False
+        self.kicked = False # Only the kick message is left to send
+        self.version = 2
+        self.cursor = None # Newest pointer message not yet sent; it jumps the queue and replaces any older one
+        self.watermark = None # (x, y, font size, alpha, text) the teacher sent for this viewer
+        self.band_text = None # Watermark text in the band last stamped for this viewer
+        self.band_box = None
+
+    def push(self, data, keyframe=None):
+        """Queues one framed message; keyframe is None for control messages. Returns True if a keyframe is needed."""
+        with self.cond:
+            if self.kicked:
+                return False
+            if keyframe is not None:
+                if keyframe:
+                    self.queue = collections.deque(item for item in self.queue if item[1] is None) # Superseded frames
+                    self.synced = True
+                elif not self.synced:
+                    return False
+                if len(self.queue) >= RELAY_QUEUE_LIMIT: # Too far behind: skip to the next keyframe
+                    self.queue.clear()
+                    self.synced = False
+                    return True
+            self.queue.append((data, keyframe))
+            self.cond.notify()
+        return False
+
+    def push_cursor(self, data):
+        with self.cond:
+            if not self.kicked:
+                self.cursor = data
+            self.cond.notify()
+
+    def kick(self, data):
+        """Sends the viewer its kick, so it knows not to rejoin the teacher, then disconnects it."""
+        with self.cond:
+            self.queue = collections.deque([(data, None)])
+            self.cursor = None
+            self.kicked = True
+            self.cond.notify()
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.cursor and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    if self.cursor:
+                        data, self.cursor = self.cursor, None
+                    else:
+                        data, _ = self.queue.popleft()
+                self.sock.sendall(data)
+                if self.kicked and not self.queue:
+                    return
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class StreamRelay:
+    """Re-serves the teacher's stream to downstream students, speaking the teacher's v2 protocol to them.
+
+    The teacher sends a relay unstamped frames and, for each viewer, that viewer's watermark as metadata. The
+    relay burns the watermark into a band tile, like the teacher's own band tiles, and adds it to the frames it
+    forwards, so viewers get pixels that are already stamped and a modified viewer has nothing to leave out.
+    Only the top rows of the stream, where every band lies, are decoded for this.
+    """
+    def __init__(self, port, capacity, on_roster_change, request_keyframe):
+        self.listener = socket.create_server(("", port))
+        self.port = port
+        self.capacity = capacity
+        self.on_roster_change = on_roster_change
+        self.request_keyframe = request_keyframe
+        self.viewers = {} # "ip:port" -> RelayViewer
+        self.lock = threading.Lock()
+        self.stamp_canvas = None # Top rows of the current frame, which every viewer's band lies within
+        self.frame_info = None # (seq, width, height, capture timestamp) of the last forwarded frame
+
+    def start(self):
+        threading.Thread(target=self._accept_viewers, daemon=True).start()
+
+    def _accept_viewers(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                return # Closed
+            with self.lock:
+                full = len(self.viewers) >= self.capacity
+            if full:
+                sock.close()
+            else:
+                threading.Thread(target=self._serve_viewer, args=(sock, f"{address[0]}:{address[1]}"), daemon=True).start()
+
+    def _serve_viewer(self, sock, address):
+        """Handshakes with one viewer, then reads its upstream messages until it leaves."""
+        viewer = RelayViewer(sock, address)
+        try:
+            sock.settimeout(RELAY_CONNECT_TIMEOUT)
+            kind, size = CLIENT_MESSAGE.unpack(recv_exact(sock, CLIENT_MESSAGE.size))
+            if kind != CLIENT_MSG_HELLO or size != HELLO.size:
+                return # Only v2 students are ever redirected here
+            viewer.version = min(HELLO.unpack(recv_exact(sock, size))[1], PROTOCOL_VERSION)
+            sock.sendall(MESSAGE_HEADER.pack(MSG_WELCOME, WELCOME.size) + WELCOME.pack(viewer.version, CODEC_JPEG))
+            sock.settimeout(None)
+            with self.lock:
+                self.viewers[address] = viewer
+            threading.Thread(target=viewer.run, daemon=True).start()
+            print(f"[RELAY] {address} joined")
+            self.on_roster_change()
+            self.request_keyframe()
+            while True:
+                kind, value = CLIENT_MESSAGE.unpack(recv_exact(sock, CLIENT_MESSAGE.size))
+                if kind == CLIENT_MSG_KEYFRAME:
+                    self.request_keyframe()
+                elif kind in (CLIENT_MSG_STATS, CLIENT_MSG_VIEWPORT):
+                    recv_exact(sock, value) # Meant for the teacher; a relay has no use for them
+        except (OSError, ConnectionError, struct.error):
+            pass
+        finally:
+            viewer.close()
+            sock.close()
+            with self.lock:
+                removed = self.viewers.pop(address, None) is viewer
+            if removed:
+                print(f"[RELAY] {address} left")
+                self.on_roster_change()
+
+    def forward(self, msg_type, message):
+        """Passes one frame message on to every viewer, in order, with the viewer's band added wherever it changed.
+
+        A full frame goes out as a keyframe of two tiles, the frame itself and the band, so it is never re-encoded.
+        Viewers that fell behind restart at a keyframe.
+        """
+        if msg_type == MSG_FRAME:
+            codec, seq, width, height, captured_at = FRAME_HEADER.unpack_from(message)
+            keyframe, tiles = True, [((0, 0, width, height), codec, message[FRAME_HEADER.size:])]
+        else:
+            _, flags, seq, width, height, tile_count, captured_at = TILE_FRAME_HEADER.unpack_from(message)
+            keyframe, tiles, offset = bool(flags & TILE_FLAG_KEYFRAME), [], TILE_FRAME_HEADER.size
+            for _ in range(tile_count):
+                x, y, tile_width, tile_height, codec, length = TILE_HEADER.unpack_from(message, offset)
+                offset += TILE_HEADER.size
+                tiles.append(((x, y, x + tile_width, y + tile_height), codec, message[offset:offset + length]))
+                offset += length
+        self.frame_info = (seq, width, height, captured_at)
+        self._update_stamp_canvas((width, height), tiles, keyframe)
+        unchanged = MESSAGE_HEADER.pack(msg_type, len(message)) + message if msg_type == MSG_TILES else None
+        with self.lock:
+            viewers = list(self.viewers.values())
+        resync = False
+        for viewer in viewers:
+            band = self._band_tile(viewer, tiles, force=keyframe)
+            data = unchanged if band is None and unchanged is not None else self._tile_message(keyframe, tiles + ([band] if band else []))
+            resync |= viewer.push(data, keyframe)
+        if resync:
+            self.request_keyframe()
+
+    def set_watermark(self, entry, meta):
+        """Stores the watermark the teacher sent for one viewer and stamps it at once, so it also ticks on an idle screen."""
+        with self.lock:
+            viewer = self.viewers.get(unpack_roster_entry(entry))
+        if viewer is None:
+            return
+        x, y, font_size, alpha = WATERMARK_META_HEADER.unpack_from(meta)[1:]
+        viewer.watermark = (x, y, font_size, alpha, bytes(meta[WATERMARK_META_HEADER.size:]).decode('utf-8', 'replace'))
+        band = self._band_tile(viewer)
+        if band is not None:
+            viewer.push(self._tile_message(False, [band]), keyframe=False)
+
+    def _update_stamp_canvas(self, size, tiles, keyframe):
+        """Composites the tiles that reach into the top eighth of the frame, where the bands are stamped from."""
+        region = (size[0], max(1, size[1] // 8))
+        if self.stamp_canvas is None or self.stamp_canvas.size != region:
+            if not keyframe:
+                self.stamp_canvas = None # Nothing to stamp onto until the next keyframe
+                return
+            self.stamp_canvas = Image.new("RGB", region)
+        for box, codec, data in tiles:
+            if box[1] < region[1]:
+                try:
+                    self.stamp_canvas.paste(decode_image(data, codec, (box[2] - box[0], box[3] - box[1])), box[:2])
+                except (OSError, ValueError):
+                    pass # The viewers' own decoders will reject the same tile
+
+    def _band_tile(self, viewer, tiles=(), force=False):
+        """The viewer's band, stamped over the current pixels, when tiles cover it, its text changed or force is set."""
+        if viewer.watermark is None or self.stamp_canvas is None or self.frame_info is None:
+            return None
+        x, y, font_size, alpha, text = viewer.watermark
+        font = load_watermark_font(font_size)
+        _, _, text_right, text_bottom = font.getbbox(text)
+        align = lambda value: -(-value // RELAY_BAND_ALIGNMENT) * RELAY_BAND_ALIGNMENT
+        box = (0, 0, min(self.stamp_canvas.width, align(2 * x + text_right)), min(self.stamp_canvas.height, align(y + text_bottom)))
+        if not force and text == viewer.band_text and not any(left < box[2] and top < box[3] for (left, top, _, _), _, _ in tiles):
+            return None
+        previous, viewer.band_box = viewer.band_box, box
+        if previous and not force: # A band that shrank has to clean up what the larger one left behind
+            box = (0, 0, min(self.stamp_canvas.width, max(box[2], previous[2])), min(self.stamp_canvas.height, max(box[3], previous[3])))
+        band = self.stamp_canvas.crop(box)
+        mask = Image.new("L", band.size)
+        ImageDraw.Draw(mask).text((x, y), text, font=font, fill=alpha)
+        band.paste((255, 255, 255), (0, 0), mask)
+        viewer.band_text = text
+        with io.BytesIO() as mem_file:
+            band.save(mem_file, 'JPEG', quality=RELAY_BAND_QUALITY)
+            return box, CODEC_JPEG, mem_file.getvalue()
+
+    def _tile_message(self, keyframe, tiles):
+        """A framed MSG_TILES message of (box, codec, data) tiles for the last forwarded frame."""
+        seq, width, height, captured_at = self.frame_info
+        parts = [TILE_FRAME_HEADER.pack(TILE_FRAME_MAGIC, TILE_FLAG_KEYFRAME if keyframe else 0, seq, width, height, len(tiles), captured_at)]
+        for (left, top, right, bottom), codec, data in tiles:
+            parts += [TILE_HEADER.pack(left, top, right - left, bottom - top, codec, len(data)), data]
+        body = b''.join(parts)
+        return MESSAGE_HEADER.pack(MSG_TILES, len(body)) + body
+
+    def forward_cursor(self, message):
+        """Passes the teacher's pointer on to every viewer that understands it, ahead of any queued frames."""
+        data = MESSAGE_HEADER.pack(MSG_CURSOR, len(message)) + message
+        with self.lock:
+            viewers = [viewer for viewer in self.viewers.values() if viewer.version >= 3]
+        for viewer in viewers:
+            viewer.push_cursor(data)
+
+    def drop(self, entry):
+        with self.lock:
+            viewer = self.viewers.get(unpack_roster_entry(entry))
+        if viewer:
+            viewer.kick(MESSAGE_HEADER.pack(MSG_RELAY_KICK, len(entry)) + entry)
+
+    def roster(self):
+        with self.lock:
+            addresses = list(self.viewers)
+        entries = b''.join(ROSTER_ENTRY.pack(socket.inet_aton(ip), int(port)) for ip, port in (a.rsplit(':', 1) for a in addresses))
+        return ROSTER.pack(self.capacity, len(addresses)) + entries
+
+    def close(self):
+        self.listener.close()
+        with self.lock:
+            viewers, self.viewers = list(self.viewers.values()), {}
+        for viewer in viewers:
+            viewer.close()
+
+def unpack_roster_entry(entry):
+    ip, port = ROSTER_ENTRY.unpack_from(entry)
+    return f"{socket.inet_ntoa(ip)}:{port}"
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+class BufferPool:
+    """Recycles receive buffers so a long session allocates a handful of buffers instead of one per frame."""
+    def __init__(self, limit=RECEIVE_POOL_LIMIT):
+        self.limit = limit
+        self.free = []
+        self.lock = threading.Lock()
+        self.allocations = 0
+        self.reuses = 0
+
+    def acquire(self, size):
+        """Returns a bytearray of at least size bytes; size must not exceed MAX_IMAGE_SIZE."""
+        with self.lock:
+            fitting = [buffer for buffer in self.free if len(buffer) >= size]
+            if fitting:
+                buffer = min(fitting, key=len)
+                self.free.remove(buffer)
+                self.reuses += 1
+                return buffer
+            self.allocations += 1
+        capacity = RECEIVE_BUFFER_MIN
+        while capacity < size:
+            capacity *= 2
+        return bytearray(min(capacity, MAX_IMAGE_SIZE))
+
+    def release(self, buffer):
+        with self.lock:
+            if len(self.free) < self.limit:
+                self.free.append(buffer)
+
+    def stats(self):
+        return {"allocations": self.allocations, "reuses": self.reuses, "idle": len(self.free)}
+
+class FrameReader(io.RawIOBase):
+    """Read-only file over a memoryview, so Pillow decodes out of a receive buffer without a copy of the whole message.
+
+    Pillow still asks for bytes, so each read copies the chunk it requests (a few KB at a time); readinto copies
+    straight into the caller's buffer.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else min(self.pos + size, len(self.view))
+        data = self.view[self.pos:end].tobytes()
+        self.pos = max(self.pos, end)
+        return data
+
+    def readinto(self, target):
+        end = min(self.pos + len(target), len(self.view))
+        count = max(0, end - self.pos)
+        target[:count] = self.view[self.pos:end]
+        self.pos += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.view)}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+class StageTimings:
+    """Moving averages, in milliseconds, of how long each pipeline stage takes."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ms = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            previous = self._ms.get(stage)
+            self._ms[stage] = seconds * 1000 if previous is None else previous + STAGE_SMOOTHING * (seconds * 1000 - previous)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: round(ms, 2) for stage, ms in self._ms.items()}
+
+def open_metrics_log(path=METRICS_LOG_PATH):
+    """Returns a logger writing JSON lines to a size-rotated file, or None when metrics logging is off."""
+    if not path:
+        return None
+    logger = logging.getLogger("insightlink.metrics")
+    if not logger.handlers:
+        try:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=METRICS_LOG_MAX_BYTES, backupCount=METRICS_LOG_BACKUPS)
+        except OSError as e:
+            print(f"Warning: Could not open metrics log '{path}' ({e}). Metrics will not be logged.")
+            return None
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+def log_metrics(logger, record):
+    if logger is not None:
+        logger.info(json.dumps(dict(record, time=round(time.time(), 3))))
+
+def frame_capture_time(message):
+    """Returns the teacher's capture timestamp carried by a frame message, or 0.0 if it has none."""
+    if message[:len(TILE_FRAME_MAGIC)] == TILE_FRAME_MAGIC:
+        return TILE_FRAME_HEADER.unpack_from(message)[6]
+    if len(message) >= 2 + FRAME_INFO_SEGMENT.size and message[2:4] == b'\xff\xfe':
+        _, _, magic, _, captured_at = FRAME_INFO_SEGMENT.unpack_from(message, 2)
+        if magic == FRAME_INFO_MAGIC:
+            return captured_at
+    return 0.0
+
+def decode_image(data, codec, size):
+    """Opens one encoded image; zlib-raw is inflated no further than size, so a corrupt message can't balloon."""
+    if codec == CODEC_ZLIB_RAW:
+        expected = size[0] * size[1] * 3
+        pixels = zlib.decompressobj().decompress(data, expected)
+        if len(pixels) != expected:
+            raise ValueError(f"zlib frame holds {len(pixels)} bytes, expected {expected}")
+        return Image.frombytes("RGB", size, pixels)
+    return Image.open(FrameReader(data)) # JPEG and WebP are told apart by Pillow itself
+
+class RecordingReader:
+    """A recorded session opened for playback: every segment memory-mapped, their indexes merged for seeking.
+
+    Seeking is two binary searches over the index: the message at a time, then the keyframe at or before it.
+    """
+    def __init__(self, path):
+        match = SEGMENT_NAME_REGEX.match(path)
+        paths = sorted(glob.glob(glob.escape(match.group(1)) + "-*" + RECORD_SUFFIX)) if match else [path]
+        self.maps = []
+        self.times = [] # Capture timestamp of every message, across all segments
+        self.locations = [] # (segment, offset) of every message
+        self.keyframes = [] # Positions in times/locations of the keyframes
+        for path in paths:
+            self._add_segment(path)
+        if not self.times:
+            raise ValueError("the recording holds no frames")
+        self.start, self.end = self.times[0], self.times[-1]
+
+    def _add_segment(self, path):
+        with open(path, "rb") as data:
+            segment = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(segment) < RECORD_HEADER.size or RECORD_HEADER.unpack_from(segment)[0] != RECORD_MAGIC:
+            segment.close()
+            raise ValueError(f"{os.path.basename(path)} is not an InsightLink recording")
+        number = len(self.maps)
+        self.maps.append(segment)
+        with open(path[:-len(RECORD_SUFFIX)] + RECORD_INDEX_SUFFIX, "rb") as index:
+            entries = index.read()
+        for captured_at, offset, flags in RECORD_INDEX_ENTRY.iter_unpack(entries[:len(entries) - len(entries) % RECORD_INDEX_ENTRY.size]):
+            if offset + MESSAGE_HEADER.size + MESSAGE_HEADER.unpack_from(segment, offset)[1] > len(segment):
+                break # The teacher stopped mid-write
+            if self.times and captured_at < self.times[-1]:
+                continue # Keeps the timeline sorted for bisect
+            if flags & RECORD_FLAG_KEYFRAME:
+                self.keyframes.append(len(self.times))
+            self.times.append(captured_at)
+            self.locations.append((number, offset))
+
+    def __len__(self):
+        return len(self.times)
+
+    def message(self, position):
+        """Returns (message type, body) of a message, the body a zero-copy view into the mapped segment."""
+        segment, offset = self.locations[position]
+        msg_type, length = MESSAGE_HEADER.unpack_from(self.maps[segment], offset)
+        start = offset + MESSAGE_HEADER.size
+        return msg_type, memoryview(self.maps[segment])[start:start + length]
+
+    def seek(self, timestamp):
+        """Returns (keyframe position, target position): decoding from the first up to the second shows timestamp."""
+        target = max(0, bisect.bisect_right(self.times, timestamp) - 1)
+        keyframe = bisect.bisect_right(self.keyframes, target) - 1
+        return (self.keyframes[keyframe] if keyframe >= 0 else 0), target
+
+    def close(self):
+        for segment in self.maps:
+            try:
+                segment.close()
+            except BufferError:
+                pass # A frame view is still being decoded; the map goes away with it
+
+@functools.lru_cache(maxsize=8)
+def load_watermark_font(size):
+    try:
+        return ImageFont.truetype(resource_path("arial.ttf"), size)
+    except IOError:
+        try:
+            return ImageFont.load_default(size)
+        except TypeError: # Pillow < 10.1 has a single fixed-size default font
+            return ImageFont.load_default()
 
 # --- Regular Expressions ---
 # Basic regex to validate an IPv4 address format.
@@ -44,7 +701,46 @@ class StudentApp:
         self.is_connected = False
         self.client_socket = None
         self.stream_window = None
-        self.stream_label = None
+        self.stream_view = None
+        self.stream_image = None
+        self.canvas = None
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.bytes_received = 0
+        self.buffer_pool = BufferPool()
+        self.header_buffer = bytearray(8)
+        self.protocol_version = 1
+        self.screen_size = (0, 0)
+        self.send_lock = threading.Lock()
+        self.decode_cond = threading.Condition()
+        self.decode_queue = []
+        self.render_lock = threading.Lock()
+        self.render_image = None
+        self.render_scheduled = False
+        self.photo = None
+        self.cursor = (0, 0, CURSOR_HIDDEN) # The teacher's pointer, as last received
+        self.cursor_item = None
+        self.cursor_item_shape = None
+        self.cursor_scheduled = False
+        self.display_size = (0, 0)
+        self.reported_size = None # Window size the teacher was last told about
+        self.viewport_report_pending = False
+        self.timings = StageTimings()
+        self.metrics_log = open_metrics_log()
+        self.frames_shown = 0
+        self.last_shown = (0.0, 0.0) # (capture time, local time shown) of the newest frame on screen
+        self.report_window = (time.time(), 0)
+        self.multicast_active = False
+        self.watermark_meta = None
+        self.relay = None
+        self.relay_address = None # The relay the teacher redirected us to, while watching through one
+        self.teacher_address = None
+        self.rejoin_attempts = 0
+        self.recording = None
+        self.playback_lock = threading.Lock()
+        self.playback_seek = None # Timestamp the Tk thread asked the player to jump to
+        self.playback_paused = False
+        self.playback_position = 0.0
 
         self._setup_window()
         self._setup_styles()
@@ -127,6 +823,21 @@ class StudentApp:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((teacher_ip, PORT))
             self.is_connected = True
+            self.teacher_address = (teacher_ip, PORT) # Kept for rejoining if a relay we're sent to goes away
+            self.relay_address = None
+            self.rejoin_attempts = 0
+            self.screen_size = (self.window.winfo_screenwidth(), self.window.winfo_screenheight())
+            self.reported_size = None
+            self.relay = self._open_relay()
+            self.frames_received = self.frames_dropped = self.bytes_received = 0
+            self.buffer_pool = BufferPool()
+            self.canvas = self.photo = self.render_image = None
+            self.cursor = (0, 0, CURSOR_HIDDEN)
+            self.decode_queue = []
+            self.timings = StageTimings()
+            self.frames_shown = 0
+            self.last_shown = (0.0, 0.0)
+            self.report_window = (time.time(), 0)
         except (socket.gaierror, ConnectionRefusedError, socket.timeout):
             messagebox.showerror("Connection Failed", f"Could not connect to {teacher_ip}.\nPlease check the IP address and ensure the teacher's session is active.")
             if self.client_socket: self.client_socket.close()
@@ -136,6 +847,7 @@ class StudentApp:
         self._open_stream_window()
 
         threading.Thread(target=self._receive_stream, daemon=True).start()
+        threading.Thread(target=self._decode_frames, daemon=True).start()
 
     def _open_stream_window(self):
         """Creates the immersive, fullscreen window for viewing the stream."""
@@ -147,8 +859,12 @@ class StudentApp:
         except Exception:
             pass # Icon for stream window is less critical if it fails
         
-        self.stream_label = ttk.Label(self.stream_window, background="black")
-        self.stream_label.pack(fill=tk.BOTH, expand=True)
+        # A canvas rather than a label, so the teacher's pointer can be drawn over the picture as a shape of its own.
+        self.stream_view = tk.Canvas(self.stream_window, background="black", highlightthickness=0)
+        self.stream_view.pack(fill=tk.BOTH, expand=True)
+        self.stream_image = self.stream_view.create_image(0, 0, anchor=tk.CENTER)
+        self.cursor_item = self.cursor_item_shape = None
+        self.stream_view.bind("<Configure>", self._on_stream_resize)
 
         self.stream_window.bind("<Escape>", self._handle_escape)
         self.stream_window.protocol("WM_DELETE_WINDOW", self._on_closing)
@@ -157,62 +873,519 @@ class StudentApp:
         """Allows toggling fullscreen mode with the Escape key."""
         is_fullscreen = self.stream_window.attributes("-fullscreen")
         self.stream_window.attributes("-fullscreen", not is_fullscreen)
+        self._schedule_viewport_report() # The teacher sizes our frames to the window
+
+    def _on_stream_resize(self, event):
+        # The decode worker must not query Tk, so the view's size is tracked here on the Tk thread.
+        self.display_size = (event.width, event.height)
+        self.stream_view.coords(self.stream_image, event.width // 2, event.height // 2)
+        self._draw_cursor()
+        self._schedule_viewport_report()
+
+    def _schedule_viewport_report(self):
+        if not self.viewport_report_pending:
+            self.viewport_report_pending = True
+            self.window.after(VIEWPORT_REPORT_DELAY, self._report_viewport)
+
+    def _report_viewport(self):
+        """Tells a v2 teacher the window's settled size, so it sends frames from the closest size bucket."""
+        self.viewport_report_pending = False
+        size = self.display_size
+        if not self.is_connected or self.protocol_version < 2 or size == self.reported_size or min(size) <= 1:
+            return
+        try:
+            self._send_client_message(CLIENT_MSG_VIEWPORT, VIEWPORT.size, VIEWPORT.pack(*(min(side, 0xFFFF) for side in size)))
+            self.reported_size = size
+        except OSError:
+            pass # The receive thread notices the broken connection
 
     def _receive_stream(self):
         """The core loop for receiving and displaying image data from the server."""
         try:
+            while True:
+                try:
+                    self._receive_messages()
+                except (ConnectionError, OSError) as e:
+                    print(f"Connection lost: {e}")
+                if not self._rejoin_teacher():
+                    break
+        finally:
+            self.is_connected = False
+            if self.relay:
+                self.relay.close()
+            with self.decode_cond:
+                self.decode_cond.notify_all()
+            print(f"[STATS] {self.frames_received} messages, {self.bytes_received} bytes received, "
+                  f"{self.frames_dropped} frames dropped, buffers: {self.buffer_pool.stats()}")
+            if self.client_socket: self.client_socket.close()
+            if self.stream_window and self.stream_window.winfo_exists():
+                 self.window.after(0, lambda: messagebox.showinfo("Disconnected", "Connection to the teacher has been closed."))
+                 self.window.after(10, self._on_closing)
+
+    def _receive_messages(self):
+        """Handles one connection's messages until it closes."""
+        pending = self._negotiate()
+        while self.is_connected:
+            header, pending = pending or self._read_header(), None
+            if header is None: break
+            msg_type, image_size = header
+
+            limit = MESSAGE_LIMITS.get(msg_type, UNKNOWN_MESSAGE_LIMIT)
+            if image_size > limit:
+                print(f"Error: Incoming message (type {msg_type}, {image_size} bytes) exceeds the limit of {limit} bytes.")
+                break
+            
+            buffer = self.buffer_pool.acquire(image_size)
+            message = memoryview(buffer)[:image_size]
+            receive_start = time.perf_counter()
+            if not self._receive_into(message):
+                self.buffer_pool.release(buffer)
+                break
+            self.timings.add("receive", time.perf_counter() - receive_start)
+
+            self._handle_message(msg_type, message, buffer)
+            if msg_type == MSG_CURSOR:
+                continue # Sent beside the frame stream; acking it would throw the teacher's frame count off
+            self.frames_received += 1
+            if self.protocol_version < 2:
+                continue # An original teacher never reads from the socket; anything sent would only pile up
+            # Acknowledge every message once it has been handled so the teacher can measure round trips.
+            self._send_client_message(CLIENT_MSG_ACK, self.frames_received)
+            if time.time() - self.report_window[0] >= STATS_REPORT_INTERVAL:
+                self._report_stats()
+
+    def _negotiate(self):
+        """Sends the hello and works out the teacher's protocol from its first reply.
+
+        Returns the header of the first frame when the teacher turns out to be v1, otherwise None.
+        """
+        self._send_client_message(CLIENT_MSG_HELLO, HELLO.size, HELLO.pack(HELLO_MAGIC, PROTOCOL_VERSION, STUDENT_CODECS, *self.screen_size,
+                                                                         DECODE_BUDGET_MS, self.relay.port if self.relay else 0))
+        first = memoryview(self.header_buffer)[:MESSAGE_HEADER.size]
+        if not self._receive_into(first):
+            raise ConnectionError("closed during the handshake")
+        msg_type, length = MESSAGE_HEADER.unpack(first)
+        if msg_type in (MSG_WELCOME, MSG_REDIRECT) and length == MESSAGE_LIMITS[msg_type]:
+            body = bytearray(length)
+            if not self._receive_into(memoryview(body)):
+                raise ConnectionError("closed during the handshake")
+            if msg_type == MSG_REDIRECT:
+                self._follow_redirect(body)
+                return self._negotiate() # Start over with the relay
+            version, codecs = WELCOME.unpack(body)
+            self.protocol_version = min(version, PROTOCOL_VERSION)
+            self.rejoin_attempts = 0 # Being welcomed, by the teacher or a relay, ends a run of failed rejoins
+            print(f"[PROTOCOL] v{self.protocol_version}; the teacher can send {codecs:#04x}, we decode {STUDENT_CODECS:#04x}")
+            self.window.after(0, self._schedule_viewport_report) # The window may have settled while the hello was in flight
+            if self.relay:
+                self.relay.start()
+                self._report_roster()
+            return None
+        if self.relay: # Original teachers know nothing about relays
+            self.relay.close()
+            self.relay = None
+        if msg_type != MSG_LEGACY:
+            raise ConnectionError(f"unexpected first message type {msg_type}")
+        # An original teacher: those bytes began the ">Q" length of its first JPEG.
+        self.protocol_version = 1
+        if not self._receive_into(memoryview(self.header_buffer)[MESSAGE_HEADER.size:]):
+            raise ConnectionError("closed before the first frame")
+        print("[PROTOCOL] v1 teacher; receiving plain JPEG frames")
+        return MSG_LEGACY, struct.unpack(">Q", self.header_buffer)[0]
+
+    def _follow_redirect(self, body):
+        """Reconnects to the relay the teacher assigned us to; the handshake then starts over with it."""
+        ip, port = REDIRECT.unpack(body)
+        address = (socket.inet_ntoa(ip), port)
+        print(f"[RELAY] The teacher assigned us to the relay at {address[0]}:{address[1]}")
+        self.relay_address = address # Set first, so a relay that can't be reached is rejoined from like a lost one
+        relay_socket = socket.create_connection(address, timeout=RELAY_CONNECT_TIMEOUT)
+        relay_socket.settimeout(None)
+        with self.send_lock:
+            self.client_socket.close()
+            self.client_socket = relay_socket
+
+    def _rejoin_teacher(self):
+        """After losing our relay, connects straight back to the teacher, which serves us itself or picks another relay.
+
+        Returns False when there is nothing to rejoin: we were watching the teacher directly, or the viewer was closed.
+        """
+        if not self.is_connected or self.relay_address is None or self.rejoin_attempts >= RELAY_REJOIN_ATTEMPTS:
+            return False
+        print(f"[RELAY] Lost the relay at {self.relay_address[0]}:{self.relay_address[1]}; rejoining the teacher")
+        self.relay_address = None
+        self.rejoin_attempts += 1
+        time.sleep(RELAY_REJOIN_DELAY) # Until the teacher notices too, it would only send us back to the same relay
+        if not self.is_connected:
+            return False
+        try:
+            teacher_socket = socket.create_connection(self.teacher_address, timeout=RELAY_CONNECT_TIMEOUT)
+        except OSError as e:
+            print(f"Could not rejoin the teacher: {e}")
+            return False
+        teacher_socket.settimeout(None)
+        with self.send_lock:
+            self.client_socket.close()
+            self.client_socket = teacher_socket
+        self.frames_received = 0 # The teacher counts acks per connection
+        self.reported_size = None
+        return True
+
+    def _open_relay(self):
+        """Starts listening for downstream students when this student is configured as a relay."""
+        if not RELAY_PORT:
+            return None
+        try:
+            return StreamRelay(RELAY_PORT, RELAY_CAPACITY, self._report_roster, lambda: self._send_client_message(CLIENT_MSG_KEYFRAME))
+        except OSError as e:
+            print(f"Warning: Could not listen on relay port {RELAY_PORT} ({e}). Watching without relaying.")
+            return None
+
+    def _report_roster(self):
+        """Tells the teacher who watches through us, so it can watermark them and balance joiners across relays."""
+        if self.relay and self.is_connected:
+            roster = self.relay.roster()
+            try:
+                self._send_client_message(CLIENT_MSG_ROSTER, len(roster), roster)
+            except OSError:
+                pass
+
+    def _read_header(self):
+        """Reads the next message header as (type, body length), or None once the connection has closed."""
+        if self.protocol_version < 2:
+            if not self._receive_into(memoryview(self.header_buffer)): return None
+            return MSG_LEGACY, struct.unpack(">Q", self.header_buffer)[0]
+        view = memoryview(self.header_buffer)[:MESSAGE_HEADER.size]
+        if not self._receive_into(view): return None
+        return MESSAGE_HEADER.unpack(view)
+
+    def _send_client_message(self, kind, value=0, payload=b''):
+        with self.send_lock:
+            self.client_socket.sendall(CLIENT_MESSAGE.pack(kind, value) + payload)
+
+    def _report_stats(self):
+        """Sends the teacher what this student actually displayed and how long each local stage took."""
+        now = time.time()
+        started, shown_before = self.report_window
+        self.report_window = (now, self.frames_shown)
+        fps = (self.frames_shown - shown_before) / max(now - started, 1e-3)
+        captured_at, shown_at = self.last_shown
+        stages = self.timings.snapshot()
+        report = STUDENT_STATS.pack(captured_at, (now - shown_at) * 1000 if shown_at else 0.0, fps,
+                                    *(stages.get(stage, 0.0) for stage in ("receive", "decode", "resize", "display")), self.frames_dropped)
+        self._send_client_message(CLIENT_MSG_STATS, STUDENT_STATS.size, report)
+        log_metrics(self.metrics_log, {"fps": round(fps, 2), "stages": stages, "dropped": self.frames_dropped, "messages": self.frames_received,
+                                       "bytes_received": self.bytes_received, "buffers": self.buffer_pool.stats(), "multicast": self.multicast_active})
+
+    def _handle_message(self, msg_type, message, buffer=None):
+        """Dispatches one message from the teacher by its type; types this version doesn't know are skipped.
+
+        buffer is the pooled receive buffer behind message; whoever finishes with the message recycles it.
+        """
+        if msg_type in (MSG_LEGACY, MSG_FRAME, MSG_TILES):
+            if self.relay and msg_type != MSG_LEGACY:
+                self.relay.forward(msg_type, message)
+            self._queue_frame(msg_type, message, buffer)
+            return
+        if msg_type == MSG_MULTICAST_ANNOUNCE:
+            _, group, port = MULTICAST_ANNOUNCE.unpack_from(message)
+            threading.Thread(target=self._receive_multicast, args=(socket.inet_ntoa(group), port), daemon=True).start()
+        elif msg_type == MSG_CURSOR:
+            if self.relay:
+                self.relay.forward_cursor(message)
+            self.cursor = CURSOR.unpack_from(message)
+            with self.render_lock:
+                schedule, self.cursor_scheduled = not self.cursor_scheduled, True
+            if schedule:
+                try:
+                    self.window.after(0, self._draw_cursor)
+                except (RuntimeError, tk.TclError):
+                    pass # The window is already gone
+        elif msg_type == MSG_WATERMARK:
+            x, y, font_size, alpha = WATERMARK_META_HEADER.unpack_from(message)[1:]
+            self.watermark_meta = (x, y, font_size, alpha, bytes(message[WATERMARK_META_HEADER.size:]).decode('utf-8', 'replace'))
+        elif msg_type == MSG_RELAY_WATERMARK and self.relay:
+            self.relay.set_watermark(message, message[ROSTER_ENTRY.size:])
+        elif msg_type == MSG_RELAY_KICK and self.relay:
+            self.relay.drop(bytes(message))
+        elif msg_type == MSG_RELAY_KICK:
+            self.relay_address = None # The teacher removed us through our relay; losing it now is no reason to rejoin
+        if buffer is not None:
+            self.buffer_pool.release(buffer)
+
+    def _receive_multicast(self, group, port):
+        """Receives the shared broadcast from the multicast group; TCP then only carries this viewer's watermark."""
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', port))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton(MULTICAST_INTERFACE))
+            sock.settimeout(MULTICAST_SILENCE_TIMEOUT)
+        except OSError as e:
+            print(f"Warning: Could not join multicast group {group}:{port} ({e}). Staying on TCP.")
+            return
+
+        reassembler = MulticastReassembler()
+        self._queue_frame(None)
+        self.multicast_active = True
+        try:
+            self._send_client_message(CLIENT_MSG_MULTICAST, 1)
+            self._send_client_message(CLIENT_MSG_KEYFRAME)
             while self.is_connected:
-                header = self._receive_full_data(8)
-                if not header: break
-                image_size = struct.unpack(">Q", header)[0]
+                for _, payload in reassembler.add(sock.recv(65535)):
+                    if payload is None:
+                        self._queue_frame(None) # Deltas can't be applied until a fresh keyframe arrives
+                        self._send_client_message(CLIENT_MSG_KEYFRAME)
+                        continue
+                    # Every broadcast payload is one complete v2 message, as it would have arrived over TCP.
+                    msg_type, length = MESSAGE_HEADER.unpack_from(payload)
+                    if msg_type in (MSG_FRAME, MSG_TILES) and length == len(payload) - MESSAGE_HEADER.size:
+                        self._queue_frame(msg_type, memoryview(payload)[MESSAGE_HEADER.size:])
+        except socket.timeout:
+            print("Warning: Multicast stream went silent. Falling back to TCP.")
+        except OSError as e:
+            print(f"Multicast receive failed: {e}")
+        finally:
+            self.multicast_active = False
+            self.watermark_meta = None
+            sock.close()
+            if self.is_connected:
+                try:
+                    self._send_client_message(CLIENT_MSG_MULTICAST, 0)
+                except OSError:
+                    pass
 
-                if image_size > MAX_IMAGE_SIZE:
-                    print(f"Error: Incoming image size ({image_size} bytes) exceeds the limit of {MAX_IMAGE_SIZE} bytes.")
-                    break
-                
-                image_bytes = self._receive_full_data(image_size)
-                if not image_bytes: break
+    def _draw_watermark(self, display_img, ratio):
+        """Stamps the teacher-supplied watermark onto a shared (multicast or relayed) frame, scaled to the display size."""
+        x, y, font_size, alpha, text = self.watermark_meta
+        font = load_watermark_font(max(8, int(font_size * ratio)))
+        ImageDraw.Draw(display_img, "RGBA").text((int(x * ratio), int(y * ratio)), text, font=font, fill=(255, 255, 255, alpha))
+
+    # --- Display Pipeline ---
+    # Receive thread(s) -> _decode_frames worker -> _render_frame on the Tk thread. Every delta is composited in
+    # order, but only the newest result is scaled and shown; whatever the display can't keep up with is dropped.
+    def _queue_frame(self, msg_type, message=None, buffer=None):
+        """Hands a frame (or a None type, meaning 'discard the canvas') to the decode worker, waiting while it is behind."""
+        with self.decode_cond:
+            if msg_type is None or not self._is_delta(msg_type, message):
+                for queued_type, _, queued_buffer in self.decode_queue: # A full frame or a reset supersedes everything still queued
+                    self.frames_dropped += queued_type is not None
+                    if queued_buffer is not None:
+                        self.buffer_pool.release(queued_buffer)
+                self.decode_queue = []
+            while len(self.decode_queue) >= DECODE_QUEUE_LIMIT and self.is_connected:
+                self.decode_cond.wait(0.5)
+            self.decode_queue.append((msg_type, message, buffer))
+            self.decode_cond.notify_all()
+
+    @staticmethod
+    def _is_delta(msg_type, message):
+        return msg_type == MSG_TILES and not TILE_FRAME_HEADER.unpack_from(message)[1] & TILE_FLAG_KEYFRAME
 
+    def _decode_frames(self):
+        """Decode/scale stage: applies every queued message, then scales only the newest picture for display."""
+        while self.is_connected:
+            with self.decode_cond:
+                while not self.decode_queue and self.is_connected:
+                    self.decode_cond.wait(0.5)
+                messages, self.decode_queue = self.decode_queue, []
+                self.decode_cond.notify_all()
+            picture = None
+            for msg_type, message, buffer in messages:
+                if msg_type is None:
+                    self.canvas, picture = None, None
+                    continue
                 try:
-                    pil_img = Image.open(io.BytesIO(image_bytes))
-                except (UnidentifiedImageError, OSError) as img_err:
+                    with self.timings.measure("decode"):
+                        picture = self._decode_frame(msg_type, message) or picture
+                except (UnidentifiedImageError, OSError, ValueError, zlib.error, struct.error) as img_err:
                     print(f"Error parsing image data: {img_err}. Skipping frame.")
+                finally:
+                    if buffer is not None:
+                        self.buffer_pool.release(buffer) # Decoded pixels never point back into the buffer
+            if picture is not None:
+                self._scale_for_display(picture)
+
+    def _decode_frame(self, msg_type, image_bytes):
+        """Decodes one frame message into (image, full frame size, capture time).
+
+        Full JPEG frames are decoded straight at a reduced size when the window is smaller.
+        """
+        if msg_type == MSG_TILES:
+            canvas = self._apply_tile_frame(image_bytes)
+            return canvas and (canvas, canvas.size, frame_capture_time(image_bytes))
+        if msg_type == MSG_FRAME:
+            codec, _, width, height, captured_at = FRAME_HEADER.unpack_from(image_bytes)
+            pil_img = decode_image(image_bytes[FRAME_HEADER.size:], codec, (width, height))
+        else:
+            codec, captured_at = CODEC_JPEG, frame_capture_time(image_bytes)
+            pil_img = Image.open(FrameReader(image_bytes))
+        full_size = pil_img.size
+        win_w, win_h = self.display_size
+        if codec == CODEC_JPEG and win_w > 1 and win_h > 1:
+            ratio = min(win_w / full_size[0], win_h / full_size[1])
+            pil_img.draft("RGB", (int(full_size[0] * ratio), int(full_size[1] * ratio))) # DCT scaling by 1/2, 1/4 or 1/8
+        pil_img.load()
+        return pil_img, full_size, captured_at
+
+    def _scale_for_display(self, picture):
+        """Scales the newest picture to the window and passes it to the Tk thread, replacing any not yet shown."""
+        image, full_size, captured_at = picture
+        win_w, win_h = self.display_size
+        if win_w <= 1 or win_h <= 1:
+            return
+
+        ratio = min(win_w / full_size[0], win_h / full_size[1])
+        new_size = (max(1, int(full_size[0] * ratio)), max(1, int(full_size[1] * ratio)))
+        with self.timings.measure("resize"):
+            # The canvas keeps changing under later deltas, so it is always copied rather than handed over.
+            display_img = image.resize(new_size, DISPLAY_FILTER) if image.size != new_size else image.copy()
+            if self.watermark_meta: # Shared pixels from multicast or a relay; the teacher only sent our stamp
+                self._draw_watermark(display_img, ratio)
+
+        with self.render_lock:
+            if self.render_image is not None:
+                self.frames_dropped += 1
+            self.render_image = (display_img, captured_at)
+            schedule, self.render_scheduled = not self.render_scheduled, True
+        if schedule:
+            try:
+                self.window.after(0, self._render_frame)
+            except (RuntimeError, tk.TclError):
+                pass # The window is already gone
+
+    def _render_frame(self):
+        """Render stage, on the Tk thread: pastes the newest frame into one reused PhotoImage."""
+        with self.render_lock:
+            pending, self.render_image, self.render_scheduled = self.render_image, None, False
+        if pending is None or not (self.stream_window and self.stream_window.winfo_exists()):
+            return
+        image, captured_at = pending
+        with self.timings.measure("display"):
+            if self.photo is None or (self.photo.width(), self.photo.height()) != image.size:
+                self.photo = ImageTk.PhotoImage(image)
+                self.stream_view.itemconfig(self.stream_image, image=self.photo)
+                self._draw_cursor() # The picture's size or position changed under the pointer
+            else:
+                self.photo.paste(image)
+        self.frames_shown += 1
+        if captured_at != self.last_shown[0]: # Watermark refreshes repeat the capture time of the frame they update
+            self.last_shown = (captured_at, time.time())
+
+    def _draw_cursor(self):
+        """Pointer stage, on the Tk thread: moves the teacher's pointer over the picture, however old the picture is."""
+        with self.render_lock:
+            self.cursor_scheduled = False
+        if not (self.stream_window and self.stream_window.winfo_exists()):
+            return
+        x, y, shape = self.cursor
+        if self.photo is None or shape not in CURSOR_SHAPES:
+            if self.cursor_item is not None:
+                self.stream_view.itemconfig(self.cursor_item, state=tk.HIDDEN)
+            return
+        if shape != self.cursor_item_shape:
+            if self.cursor_item is not None:
+                self.stream_view.delete(self.cursor_item)
+            self.cursor_item = self.stream_view.create_polygon(CURSOR_SHAPES[shape], fill="white", outline="black")
+            self.cursor_item_shape = shape
+        width, height = self.photo.width(), self.photo.height()
+        left = (self.display_size[0] - width) // 2 + x * (width - 1) // 0xFFFF # The picture is centred in the view
+        top = (self.display_size[1] - height) // 2 + y * (height - 1) // 0xFFFF
+        points = CURSOR_SHAPES[shape]
+        self.stream_view.coords(self.cursor_item, *(value + (left if index % 2 == 0 else top) for index, value in enumerate(points)))
+        self.stream_view.itemconfig(self.cursor_item, state=tk.NORMAL)
+        self.stream_view.tag_raise(self.cursor_item)
+
+    def _apply_tile_frame(self, data):
+        """Composites the tiles of a delta/keyframe message onto the persistent canvas."""
+        data = memoryview(data) # Tiles are sliced out of the message without copying
+        _, flags, _, width, height, tile_count, _ = TILE_FRAME_HEADER.unpack_from(data)
+        if self.canvas is None or self.canvas.size != (width, height):
+            if not flags & TILE_FLAG_KEYFRAME:
+                return None # A delta is meaningless until the next keyframe arrives
+            self.canvas = Image.new("RGB", (width, height))
+
+        offset = TILE_FRAME_HEADER.size
+        for _ in range(tile_count):
+            x, y, tile_width, tile_height, codec, length = TILE_HEADER.unpack_from(data, offset)
+            offset += TILE_HEADER.size
+            self.canvas.paste(decode_image(data[offset:offset + length], codec, (tile_width, tile_height)), (x, y))
+            offset += length
+        return self.canvas
+
+    def _receive_into(self, view):
+        """Fills view completely from the socket without intermediate copies; False if the connection closed first."""
+        received = 0
+        while received < len(view):
+            count = self.client_socket.recv_into(view[received:])
+            if not count: return False
+            received += count
+        self.bytes_received += received
+        return True
+
+    # --- Recording Playback ---
+    def play_recording(self, path):
+        """Player mode: shows a recorded lecture through the same decode and display pipeline as a live stream."""
+        try:
+            self.recording = RecordingReader(path)
+        except (OSError, ValueError, struct.error) as e:
+            messagebox.showerror("Playback Failed", f"Could not open the recording:\n{e}")
+            self.window.destroy()
+            return
+        self.is_connected = True
+        self.window.withdraw()
+        self._open_stream_window()
+        self.stream_window.bind("<space>", lambda event: setattr(self, "playback_paused", not self.playback_paused))
+        self.stream_window.bind("<Left>", lambda event: self._seek_playback(-PLAYBACK_SEEK_STEP))
+        self.stream_window.bind("<Right>", lambda event: self._seek_playback(PLAYBACK_SEEK_STEP))
+        self.stream_window.bind("<Home>", lambda event: self._seek_playback(None))
+        threading.Thread(target=self._play_recording, daemon=True).start()
+        threading.Thread(target=self._decode_frames, daemon=True).start()
+        self._update_playback_title()
+
+    def _seek_playback(self, step):
+        with self.playback_lock:
+            current = self.playback_seek if self.playback_seek is not None else self.playback_position
+            self.playback_seek = self.recording.start if step is None else min(max(current + step, self.recording.start), self.recording.end)
+
+    def _play_recording(self):
+        """Feeds recorded messages to the decode worker in real time; a seek replays from the preceding keyframe."""
+        recording = self.recording
+        position, clock_offset = 0, None # clock_offset maps recording time to wall-clock time while playing
+        try:
+            while self.is_connected:
+                with self.playback_lock:
+                    seek, self.playback_seek = self.playback_seek, None
+                if seek is not None:
+                    keyframe, position = recording.seek(seek)
+                    self._queue_frame(None)
+                    for earlier in range(keyframe, position): # Deltas up to the target are applied, only the last is shown
+                        self._queue_frame(*recording.message(earlier))
+                    clock_offset = None
+                if self.playback_paused or position >= len(recording):
+                    clock_offset = None
+                    time.sleep(0.05)
                     continue
-                
-                win_w = self.stream_window.winfo_width()
-                win_h = self.stream_window.winfo_height()
-                
-                if win_w <= 1 or win_h <= 1: 
-                    time.sleep(0.1)
+                captured_at = recording.times[position]
+                if clock_offset is None:
+                    clock_offset = time.time() - captured_at
+                delay = captured_at + clock_offset - time.time()
+                if delay > 0:
+                    time.sleep(min(delay, 0.05)) # Short naps keep seeking and pausing responsive
                     continue
-
-                img_w, img_h = pil_img.size
-                
-                ratio = min(win_w / img_w, win_h / img_h)
-                new_size = (int(img_w * ratio), int(img_h * ratio))
-                
-                resized_img = pil_img.resize(new_size, Image.Resampling.LANCZOS)
-                tk_image = ImageTk.PhotoImage(resized_img)
-                
-                self.stream_label.config(image=tk_image)
-                self.stream_label.image = tk_image
-        except (ConnectionError, OSError) as e:
-            print(f"Connection lost: {e}")
+                self._queue_frame(*recording.message(position))
+                self.playback_position = captured_at
+                position += 1
         finally:
-            self.is_connected = False
-            if self.client_socket: self.client_socket.close()
-            if self.stream_window and self.stream_window.winfo_exists():
-                 self.window.after(0, lambda: messagebox.showinfo("Disconnected", "Connection to the teacher has been closed."))
-                 self.window.after(10, self._on_closing)
+            recording.close()
 
-    def _receive_full_data(self, size):
-        """A helper function to ensure the complete data packet is received from the socket."""
-        data = bytearray()
-        while len(data) < size:
-            packet = self.client_socket.recv(size - len(data))
-            if not packet: return None
-            data.extend(packet)
-        return data
+    def _update_playback_title(self):
+        if not (self.stream_window and self.stream_window.winfo_exists()):
+            return
+        elapsed = lambda timestamp: time.strftime("%H:%M:%S", time.gmtime(max(0, timestamp - self.recording.start)))
+        state = " (paused)" if self.playback_paused else ""
+        self.stream_window.title(f"Playback {elapsed(self.playback_position)} / {elapsed(self.recording.end)}{state} - {APP_NAME}")
+        self.window.after(500, self._update_playback_title)
 
     def _on_closing(self):
         """Gracefully handles the closing of the application to prevent errors."""
@@ -223,4 +1396,6 @@ class StudentApp:
 if __name__ == "__main__":
     root = tk.Tk()
     app = StudentApp(root)
+    if len(sys.argv) == 3 and sys.argv[1] == "--play": # e.g. --play recordings/lecture-20250101-090000-001.ilrec
+        app.play_recording(sys.argv[2])
     root.mainloop()
\ No newline at end of file
@@ -3,11 +3,12 @@
 # App Name: InsightLink v1.0
 # Developed by: Zihad Hasan
 
-import socket, threading, struct, io, time, sys, os, re
+import socket, threading, struct, io, time, sys, os, re, json, zlib, ctypes, functools, contextlib, asyncio, collections, concurrent.futures
+import logging, logging.handlers
 import mss
-from PIL import Image, ImageDraw, ImageFont, ImageTk, UnidentifiedImageError
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageTk, UnidentifiedImageError, features
 import tkinter as tk
-from tkinter import ttk, messagebox, Listbox, END
+from tkinter import ttk, messagebox, simpledialog
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -46,141 +47,1886 @@ QUALITY_SETTINGS = {
 }
 MAX_IMAGE_SIZE = 10 * 1024 * 1024 # 10 MB limit for incoming images
 
+# --- Protocol ---
+# v1 (the original app): every message is a bare ">Q" length followed by a JPEG, and the student never speaks.
+# v2: the student opens with a HELLO announcing what it can decode; every message then starts with a typed
+# MESSAGE_HEADER. Students that say nothing within HELLO_TIMEOUT are served v1.
+# v3 adds MSG_CURSOR, which is only sent to v3 students since it sits outside the acked frame sequence.
+PROTOCOL_VERSION = 3
+HELLO_TIMEOUT = 1.0
+HELLO_MAGIC = b'ILHI'
+HELLO = struct.Struct(">4sBBHHHH") # magic, protocol version, codec bitmask, viewer width, viewer height, decode budget (ms per frame), relay port (0 = not a relay)
+MESSAGE_HEADER = struct.Struct(">BI") # message type, body length; a v1 length prefix always starts with a zero byte instead
+MSG_WELCOME = 1 # WELCOME body; always the first v2 message
+MSG_FRAME = 2 # FRAME_HEADER + one encoded full frame
+MSG_TILES = 3 # tile frame (see pack_tile_frame)
+MSG_MULTICAST_ANNOUNCE = 4
+MSG_WATERMARK = 5
+MSG_REDIRECT = 6 # REDIRECT body: watch through this relay instead; the only message before the connection closes
+MSG_RELAY_WATERMARK = 7 # ROSTER_ENTRY of one of the relay's viewers + that viewer's watermark metadata
+MSG_RELAY_KICK = 8 # ROSTER_ENTRY of a relay viewer the teacher disconnected; the relay passes it on so the viewer won't rejoin
+MSG_KEEPALIVE = 9 # Empty; keeps the multicast group from going silent while the screen is idle
+MSG_CURSOR = 10 # CURSOR body (v3); never acked, so it can't be held up by or hold up the frame window
+WELCOME = struct.Struct(">BB") # protocol version, codecs the teacher can send
+FRAME_HEADER = struct.Struct(">BIHHd") # codec, seq, width, height, capture timestamp
+CODEC_JPEG = 0x01
+CODEC_WEBP = 0x02
+CODEC_ZLIB_RAW = 0x04 # zlib-compressed raw RGB; lossless and needs no image codec at all
+CODEC_HYBRID = CODEC_JPEG | CODEC_ZLIB_RAW # Rendition codec only: every tile goes out as zlib (text, flat UI) or JPEG (photos)
+CODEC_NAMES = {CODEC_JPEG: "JPEG", CODEC_WEBP: "WebP", CODEC_ZLIB_RAW: "zlib", CODEC_HYBRID: "JPEG+zlib"}
+TEACHER_CODECS = CODEC_JPEG | CODEC_ZLIB_RAW | (CODEC_WEBP if features.check("webp") else 0)
+WEBP_MIN_LEVEL = 3 # First adaptive level (already frame-rate limited) where WebP's smaller frames outweigh its slower encode
+ZLIB_LEVEL = 1
+HYBRID_TILES = os.environ.get("INSIGHTLINK_HYBRID_TILES", "1") != "0" # 0 = plain JPEG tiles even for students that could mix
+CURSOR = struct.Struct(">HHB") # pointer x, y in 1/65535ths of the shared screen, shape
+CURSOR_HIDDEN = 0 # Off the shared screen, or hidden by the application under it
+CURSOR_ARROW = 1
+CURSOR_IBEAM = 2
+CURSOR_HAND = 3
+CURSOR_WAIT = 4
+CURSOR_CROSS = 5
+CLIENT_COLUMNS = {"student": ("Student", 160), "quality": ("Quality", 100), "fps": ("FPS", 50), "latency": ("Latency", 70), "bandwidth": ("Bandwidth", 90), "dropped": ("Dropped", 70)}
+
+# --- Frame Pipeline ---
+JPEG_MCU_HEIGHT = 16 # 4:2:0 chroma subsampling gives 16px tall MCU rows
+WATERMARK_MARGIN = 15
+TILE_SIZE = 128 # Delta grid cell size; a multiple of the MCU size so tiles stay block-aligned
+KEYFRAME_INTERVAL = 5.0 # Seconds between full keyframes in delta mode
+DELTA_MAX_COVERAGE = 0.5 # Above this fraction of changed tiles a keyframe is cheaper than a delta
+TILE_FRAME_MAGIC = b'ILTF'
+TILE_FRAME_HEADER = struct.Struct(">4sBIHHHd") # magic, flags, seq, width, height, tile count, capture timestamp
+TILE_HEADER = struct.Struct(">HHHHBI") # x, y, width, height, codec, data length
+TILE_FLAG_KEYFRAME = 0x01
+FRAME_INFO_MAGIC = b'ILFI'
+FRAME_INFO_SEGMENT = struct.Struct(">HH4sId") # JPEG COM marker, segment length, magic, seq, capture timestamp
+ENCODE_WORKERS = int(os.environ.get("INSIGHTLINK_ENCODE_WORKERS", min(8, os.cpu_count() or 1))) # 1 = single-shot encoding
+STRIP_MIN_HEIGHT = 128 # Frames are only split into strips at least this tall
+HYBRID_MAX_COLORS = 512 # Anti-aliased text on a plain background stays well below this; photos and video don't
+HYBRID_EDGE_STEP = 48 # Luma difference between neighbouring pixels that counts as a hard edge
+HYBRID_MIN_HARD_EDGES = 0.25 # Share of hard edges among all horizontal luma changes for a tile to look like text
+HYBRID_LOSSLESS_BUDGET = 0.5 # Bytes per pixel; a "text" tile that compresses worse than this goes out as JPEG after all
+HYBRID_ZLIB_LEVEL = 6 # Text tiles are small, so the extra effort over ZLIB_LEVEL costs a fraction of a millisecond
+
+def align_up(value, alignment):
+    return -(-value // alignment) * alignment
+
+def encode_jpeg(pil_img, quality, restart_markers=False):
+    """Encodes a baseline JPEG; restart markers after every MCU row let rows be swapped later."""
+    with io.BytesIO() as mem_file:
+        if restart_markers:
+            pil_img.save(mem_file, 'JPEG', quality=quality, subsampling=2, restart_marker_rows=1)
+        else:
+            pil_img.save(mem_file, 'JPEG', quality=quality, subsampling=2)
+        return mem_file.getvalue()
+
+def encode_image(pil_img, quality, codec=CODEC_JPEG, restart_markers=False):
+    """Encodes an image with one of the negotiated codecs; zlib-raw is lossless and ignores quality."""
+    if codec == CODEC_ZLIB_RAW:
+        return zlib.compress(pil_img.convert("RGB").tobytes(), ZLIB_LEVEL)
+    if codec == CODEC_WEBP:
+        with io.BytesIO() as mem_file:
+            pil_img.save(mem_file, 'WEBP', quality=quality, method=0)
+            return mem_file.getvalue()
+    return encode_jpeg(pil_img, quality, restart_markers)
+
+def looks_like_text(pil_img):
+    """True for tiles of text, code or flat UI: few distinct colours, and mostly hard edges where the luma changes."""
+    if pil_img.getcolors(HYBRID_MAX_COLORS) is None:
+        return False
+    luma = pil_img.convert("L")
+    steps = ImageChops.difference(luma, ImageChops.offset(luma, 1, 0)).histogram()
+    changed = sum(steps[1:])
+    return not changed or sum(steps[HYBRID_EDGE_STEP:]) >= HYBRID_MIN_HARD_EDGES * changed
+
+def encode_tile(pil_img, quality, codec=CODEC_JPEG, restart_markers=False):
+    """Encodes one tile and returns (codec, data); the hybrid codec keeps text lossless and sends everything else as JPEG."""
+    if codec == CODEC_HYBRID:
+        if looks_like_text(pil_img):
+            data = zlib.compress(pil_img.convert("RGB").tobytes(), HYBRID_ZLIB_LEVEL)
+            if len(data) <= HYBRID_LOSSLESS_BUDGET * pil_img.width * pil_img.height:
+                return CODEC_ZLIB_RAW, data
+        codec = CODEC_JPEG
+    return codec, encode_image(pil_img, quality, codec, restart_markers)
+
+def choose_codec(codecs, level):
+    """The cheapest encoding a client can decode at its adaptive level.
+
+    JPEG is fast to encode and compact, so it is the default. Students that can also decode zlib get the hybrid
+    codec, which sends text tiles losslessly: sharper, and for text usually smaller than JPEG too. WebP costs the
+    teacher more CPU for roughly a third fewer bytes, which only pays off once the link is the bottleneck.
+    zlib-raw is the fallback for students that can decode neither image codec.
+    """
+    codecs &= TEACHER_CODECS
+    if codecs & CODEC_WEBP and level >= WEBP_MIN_LEVEL:
+        return CODEC_WEBP
+    if HYBRID_TILES and codecs & CODEC_HYBRID == CODEC_HYBRID:
+        return CODEC_HYBRID
+    for codec in (CODEC_JPEG, CODEC_WEBP):
+        if codecs & codec:
+            return codec
+    return CODEC_ZLIB_RAW
+
+def split_jpeg_scan(jpeg_bytes):
+    """Splits a JPEG into its header (everything up to the scan data) and its restart intervals."""
+    sos = jpeg_bytes.index(b'\xff\xda')
+    scan_start = sos + 2 + struct.unpack(">H", jpeg_bytes[sos + 2:sos + 4])[0]
+    header, scan = jpeg_bytes[:scan_start], jpeg_bytes[scan_start:-2]
+    intervals, start, pos = [], 0, scan.find(b'\xff')
+    while pos != -1:
+        if 0xd0 <= scan[pos + 1] <= 0xd7:
+            intervals.append(scan[start:pos])
+            start = pos + 2
+        pos = scan.find(b'\xff', pos + 2)
+    intervals.append(scan[start:])
+    return header, intervals
+
+def splice_jpeg_rows(header, intervals, band_intervals):
+    """Rebuilds a JPEG whose leading MCU rows come from band_intervals instead of intervals."""
+    rows = band_intervals + intervals[len(band_intervals):]
+    out = bytearray(header)
+    for index, row in enumerate(rows):
+        out += row
+        if index < len(rows) - 1:
+            out += bytes((0xff, 0xd0 + index % 8))
+    out += b'\xff\xd9'
+    return bytes(out)
+
+def strip_boxes(size, count):
+    """Splits a frame into up to count full-width strips whose heights are whole MCU rows."""
+    width, height = size
+    strip_height = align_up(-(-height // max(1, count)), JPEG_MCU_HEIGHT)
+    return [(0, y, width, min(y + strip_height, height)) for y in range(0, height, strip_height)]
+
+def join_jpeg_strips(strips, boxes):
+    """Chains restart-marked strip JPEGs of one frame into a single JPEG, or returns None if they can't be chained.
+
+    All strips share the same tables and restart interval and every restart resets the DC predictors, so
+    their MCU rows can follow each other under the first strip's header with only the frame height patched.
+    """
+    header, rows = None, []
+    for strip, box in zip(strips, boxes):
+        strip_header, intervals = split_jpeg_scan(strip)
+        if len(intervals) != -(-(box[3] - box[1]) // JPEG_MCU_HEIGHT):
+            return None # Pillow ignored restart_marker_rows
+        header = header or strip_header
+        rows += intervals
+    sof = header.find(b'\xff\xc0')
+    if sof == -1:
+        return None
+    header = header[:sof + 5] + struct.pack(">H", boxes[-1][3]) + header[sof + 7:]
+    return splice_jpeg_rows(header, rows, [])
+
+class StripEncoder:
+    """Encodes frames as horizontal strips on a thread pool so high-resolution captures use every core.
+
+    Pillow releases the GIL while it encodes, so plain threads scale without copying frames to other processes.
+    With a single worker everything is encoded in one shot on the calling thread, as before.
+    """
+    def __init__(self, workers=ENCODE_WORKERS):
+        self.workers = max(1, workers)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="encode") if self.workers > 1 else None
+        self.joinable = True
+
+    def strip_count(self, image):
+        return 1 if self.pool is None else max(1, min(self.workers, image.height // STRIP_MIN_HEIGHT))
+
+    def _map(self, encode, boxes):
+        if self.pool is None or len(boxes) < 2:
+            return [encode(box) for box in boxes]
+        return list(self.pool.map(encode, boxes))
+
+    def encode_boxes(self, image, boxes, quality, restart_markers=False, codec=CODEC_JPEG):
+        """Encodes every box of the image as its own image, spread across the pool."""
+        return self._map(lambda box: encode_image(image.crop(box), quality, codec, restart_markers), boxes)
+
+    def encode_tiles(self, image, boxes, quality, codec=CODEC_JPEG):
+        """Encodes every box as a Tile, spread across the pool; with the hybrid codec each tile picks its own codec."""
+        def encode(box):
+            tile_codec, data = encode_tile(image.crop(box), quality, codec)
+            return Tile(box, data, codec=tile_codec)
+        return self._map(encode, boxes)
+
+    def encode_keyframe(self, image, quality, codec=CODEC_JPEG):
+        """Returns keyframe tiles, one independently decodable strip each, for the student to composite."""
+        if codec == CODEC_HYBRID:
+            boxes = grid_boxes(image.size) # Classified cell by cell, like delta tiles, so text never lands in a JPEG strip
+        else:
+            boxes = strip_boxes(image.size, self.strip_count(image))
+        return self.encode_tiles(image, boxes, quality, codec)
+
+    def encode_frame(self, image, quality):
+        """Returns one restart-marked JPEG of the whole frame, encoded strip by strip where possible."""
+        count = self.strip_count(image)
+        if count > 1 and self.joinable:
+            boxes = strip_boxes(image.size, count)
+            jpeg_bytes = join_jpeg_strips(self.encode_boxes(image, boxes, quality, restart_markers=True), boxes)
+            if jpeg_bytes is not None:
+                return jpeg_bytes
+            print("Warning: This Pillow build can't write restart markers. Falling back to single-shot encoding.")
+            self.joinable = False
+        return encode_jpeg(image, quality, restart_markers=True)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+def grid_boxes(size, tile_size=TILE_SIZE):
+    """Every cell of the delta grid over a frame of this size."""
+    return [(x, y, min(x + tile_size, size[0]), min(y + tile_size, size[1]))
+            for y in range(0, size[1], tile_size) for x in range(0, size[0], tile_size)]
+
+def find_changed_tiles(previous, current, tile_size=TILE_SIZE):
+    """Returns the boxes of every grid tile whose pixels differ between two same-sized frames."""
+    diff = ImageChops.difference(previous, current)
+    bbox = diff.getbbox()
+    if not bbox:
+        return []
+    changed = []
+    for y in range(bbox[1] // tile_size * tile_size, bbox[3], tile_size):
+        for x in range(bbox[0] // tile_size * tile_size, bbox[2], tile_size):
+            box = (x, y, min(x + tile_size, current.width), min(y + tile_size, current.height))
+            if diff.crop(box).getbbox():
+                changed.append(box)
+    return changed
+
+def add_frame_info(jpeg_bytes, seq, captured_at):
+    """Tags a plain JPEG frame with its seq and capture time in a comment segment, which decoders simply skip."""
+    info = FRAME_INFO_SEGMENT.pack(0xFFFE, FRAME_INFO_SEGMENT.size - 2, FRAME_INFO_MAGIC, seq, captured_at)
+    return b''.join((jpeg_bytes[:2], info, jpeg_bytes[2:]))
+
+def pack_frame(frame, codec, data):
+    """Prefixes one encoded full frame with its FRAME_HEADER, forming a v2 MSG_FRAME body."""
+    return FRAME_HEADER.pack(codec, frame.seq, frame.image.width, frame.image.height, frame.captured_at) + data
+
+def pack_tile_frame(seq, size, tiles, keyframe=False, captured_at=0.0):
+    """Serializes tiles into a single tile-frame payload for the student to composite."""
+    flags = TILE_FLAG_KEYFRAME if keyframe else 0
+    parts = [TILE_FRAME_HEADER.pack(TILE_FRAME_MAGIC, flags, seq, size[0], size[1], len(tiles), captured_at)]
+    for tile in tiles:
+        parts.append(TILE_HEADER.pack(tile.x, tile.y, tile.width, tile.height, tile.codec, len(tile.data)))
+        parts.append(tile.data)
+    return b''.join(parts)
+
+class Tile:
+    """An encoded rectangle of the screen and the frame sequence number it was last updated in."""
+    def __init__(self, box, data, seq=0, codec=CODEC_JPEG):
+        self.x, self.y = box[0], box[1]
+        self.width, self.height = box[2] - box[0], box[3] - box[1]
+        self.data = data
+        self.seq = seq
+        self.codec = codec
+
+    def intersects(self, box):
+        return self.x < box[2] and box[0] < self.x + self.width and self.y < box[3] and box[1] < self.y + self.height
+
+class Frame:
+    """A captured screen image together with its shared, un-watermarked JPEG encoding."""
+    def __init__(self, seq, image, quality, jpeg_bytes=None, captured_at=None):
+        self.seq = seq
+        self.captured_at = captured_at or time.time()
+        self.image = image
+        self.quality = quality
+        self.jpeg_bytes = None
+        self.spliceable = False
+        self._lock = threading.Lock()
+        if jpeg_bytes is not None:
+            self._set_jpeg(jpeg_bytes)
+
+    def _set_jpeg(self, jpeg_bytes):
+        self.header, self.intervals = split_jpeg_scan(jpeg_bytes)
+        # Older Pillow builds silently ignore restart_marker_rows; splicing is only safe with one interval per MCU row.
+        self.spliceable = len(self.intervals) == -(-self.image.height // JPEG_MCU_HEIGHT)
+        self.jpeg_bytes = jpeg_bytes
+
+    def ensure_jpeg(self):
+        """Encodes the shared JPEG on first use, for v1 students watching a rendition that only publishes tiles."""
+        with self._lock:
+            if self.jpeg_bytes is None:
+                self._set_jpeg(encode_jpeg(self.image, self.quality, restart_markers=True))
+        return self.jpeg_bytes
+
+class FrameBuffer:
+    """Holds the latest captured frame so every client handler shares a single capture and encode.
+
+    In delta mode it also keeps the last keyframe and the newest version of every tile changed since,
+    so a client at any sequence number can be brought up to date without encoding anything again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frame = None
+        self.seq = 0
+        self.keyframe_seq = 0
+        self.keyframe_tiles = []
+        self.tiles = {}
+
+    def publish(self, image, quality, jpeg_bytes=None, tiles=None, keyframe=False, captured_at=None):
+        frame = Frame(self.seq + 1, image, quality, jpeg_bytes, captured_at)
+        with self._lock:
+            if keyframe:
+                self.keyframe_seq = frame.seq
+                self.keyframe_tiles = tiles
+                self.tiles = {}
+            elif tiles:
+                for tile in tiles:
+                    self.tiles[(tile.x, tile.y)] = tile
+            for tile in tiles or ():
+                tile.seq = frame.seq
+            self.seq = frame.seq
+            self.frame = frame
+
+    def collect_tiles(self, since_seq):
+        """Returns (frame, is_keyframe, tiles) needed to bring a client at since_seq to the latest frame."""
+        with self._lock:
+            if since_seq < self.keyframe_seq:
+                return self.frame, True, self.keyframe_tiles + list(self.tiles.values())
+            return self.frame, False, [tile for tile in self.tiles.values() if tile.seq > since_seq]
+
+class Rendition:
+    """One encoded variant (quality, scale, codec) of the shared capture, encoded once for every client using it."""
+    def __init__(self, quality, scale, codec=CODEC_JPEG):
+        self.quality = quality
+        self.scale = scale
+        self.codec = codec
+        self.frame_buffer = FrameBuffer()
+        self.subscribers = 0
+        self.previous_image = None
+        self.last_keyframe_time = 0
+
+    def request_keyframe(self):
+        self.last_keyframe_time = 0
+
+    def needs_encode(self):
+        """True when the next grab has to be encoded even if the screen is unchanged: the rendition is new or owes a keyframe."""
+        return self.frame_buffer.frame is None or not self.last_keyframe_time
+
+    def scaled(self, image):
+        if self.scale >= 1.0:
+            return image
+        factor = 1 / self.scale
+        if factor == int(factor):
+            return image.reduce(int(factor)) # Box-averaging 1/2 and 1/4 scales is several times cheaper than a resize
+        size = (max(16, int(image.width * self.scale)), max(16, int(image.height * self.scale)))
+        return image.resize(size, Image.Resampling.BILINEAR)
+
+    def encode(self, image, delta_mode, encoder, captured_at=None):
+        """Encodes one captured frame into this rendition's frame buffer."""
+        image = self.scaled(image)
+        if delta_mode:
+            self._publish_delta(image, encoder, captured_at)
+            return
+        self.last_keyframe_time = time.time() # Every full frame is a keyframe
+        if self.codec == CODEC_JPEG:
+            self.frame_buffer.publish(image, self.quality, jpeg_bytes=encoder.encode_frame(image, self.quality), captured_at=captured_at)
+        else:
+            self.frame_buffer.publish(image, self.quality, captured_at=captured_at) # Only for students that can't decode JPEG; stamped and encoded per client
+
+    def _publish_delta(self, image, encoder, captured_at=None):
+        """Publishes only the tiles that changed since the previous grab, or a keyframe when one is due."""
+        previous, self.previous_image = self.previous_image, image
+        if previous is not None and previous.size == image.size and self.last_keyframe_time:
+            boxes = find_changed_tiles(previous, image)
+            if not boxes:
+                return # Nothing moved, so nothing is sent; a keyframe only ever rides along with a real change
+            grid_size = (align_up(image.width, TILE_SIZE) // TILE_SIZE) * (align_up(image.height, TILE_SIZE) // TILE_SIZE)
+            if time.time() - self.last_keyframe_time < KEYFRAME_INTERVAL and len(boxes) <= grid_size * DELTA_MAX_COVERAGE:
+                tiles = encoder.encode_tiles(image, boxes, self.quality, self.codec)
+                self.frame_buffer.publish(image, self.quality, tiles=tiles, captured_at=captured_at)
+                return
+        self.last_keyframe_time = time.time()
+        tiles = encoder.encode_keyframe(image, self.quality, self.codec)
+        self.frame_buffer.publish(image, self.quality, tiles=tiles, keyframe=True, captured_at=captured_at)
+
+# --- Capture Scheduling ---
+# The quality profile's delay is the capture interval for ordinary activity. While much of the screen keeps moving
+# (scrolling, video) grabs speed up towards CAPTURE_MOTION_SPEEDUP times that rate; an idle screen is only polled.
+ADAPTIVE_CAPTURE = os.environ.get("INSIGHTLINK_ADAPTIVE_CAPTURE", "1") != "0" # 0 = grab and encode at the profile's fixed rate
+CAPTURE_MAX_FPS = int(os.environ.get("INSIGHTLINK_MAX_CAPTURE_FPS", 60))
+CAPTURE_MOTION_SPEEDUP = 2.0
+CAPTURE_IDLE_AFTER = 1.0 # Seconds without a change before grabs start backing off
+CAPTURE_IDLE_INTERVAL = 0.25 # Slowest polling of an idle screen; also the worst-case delay before a change is noticed
+CAPTURE_BACKOFF = 1.5 # Growth of the grab interval per unchanged grab once idle
+CHANGE_BAND_HEIGHT = 2 # Rows of the reduced grab per checksummed band (16 screen rows)
+CHANGE_REDUCE = 8 # Grabs are box-averaged by this factor before checksumming; a fraction of the cost of the full frame
+CHANGE_RECHECK_INTERVAL = 2.0 # In delta mode an unchanged grab is still tile-diffed this often, catching changes too faint to survive the reduction
+MOTION_SMOOTHING = 0.3 # Weight of the newest grab in the moving average of the changed fraction
+MOTION_FULL_SPEED = 0.25 # Average fraction of bands changing per grab at which capture reaches its fastest rate
+
+def motion_capture_interval(delay):
+    """The shortest capture interval, reached during sustained motion, for a profile's delay."""
+    return max(1 / CAPTURE_MAX_FPS, delay / CAPTURE_MOTION_SPEEDUP) if ADAPTIVE_CAPTURE else delay
+
+class CaptureScheduler:
+    """Paces the capture loop by how much of the screen changes between grabs.
+
+    Change is detected with a CRC of every band of a CHANGE_REDUCE times smaller copy of the grab, under two
+    milliseconds for a full HD grab and far cheaper than a pixel diff, so unchanged grabs can skip encoding altogether.
+    """
+    def __init__(self, delay, recheck=True):
+        self.adaptive = ADAPTIVE_CAPTURE
+        self.recheck = recheck # Plain mode would re-encode the whole frame; its per-second watermark refresh resends it anyway
+        self.base_interval = delay
+        self.min_interval = motion_capture_interval(delay)
+        self.interval = delay
+        self.activity = 0.0 # Moving average of the fraction of bands changed per grab
+        self.checksums = None
+        self.last_change = self.last_recheck = time.time()
+        self.grabs = 0
+        self.changes = 0
+
+    def observe(self, image):
+        """Checksums a grab and adjusts the interval; returns True if the screen changed since the previous grab."""
+        self.grabs += 1
+        if not self.adaptive:
+            self.changes += 1
+            return True
+        reduced = image.reduce(CHANGE_REDUCE)
+        data = memoryview(reduced.tobytes())
+        band = reduced.width * len(reduced.getbands()) * CHANGE_BAND_HEIGHT
+        checksums = [zlib.crc32(data[offset:offset + band]) for offset in range(0, len(data), band)]
+        if self.checksums is None or len(checksums) != len(self.checksums):
+            changed = 1.0
+        else:
+            changed = sum(1 for old, new in zip(self.checksums, checksums) if old != new) / len(checksums)
+        self.checksums = checksums
+        self.activity += MOTION_SMOOTHING * (changed - self.activity)
+        now = time.time()
+        if changed:
+            self.changes += 1
+            self.last_change = now
+            # From the profile's rate for a blinking cursor or a new slide, up to the cap for sustained motion.
+            speed = min(1.0, self.activity / MOTION_FULL_SPEED)
+            self.interval = self.base_interval - (self.base_interval - self.min_interval) * speed
+        elif now - self.last_change >= CAPTURE_IDLE_AFTER:
+            self.interval = min(CAPTURE_IDLE_INTERVAL, max(self.interval, self.base_interval) * CAPTURE_BACKOFF)
+        else:
+            self.interval = self.base_interval
+        if changed or self.recheck and now - self.last_recheck >= CHANGE_RECHECK_INTERVAL:
+            self.last_recheck = now
+            return True
+        return False
+
+# --- Adaptive Streaming ---
+# Each level is (JPEG quality, resolution scale, minimum frame interval in seconds). A client starts at the first
+# level its quality profile allows and never climbs above it; congestion walks it down the ladder one step at a time.
+ADAPTIVE_LEVELS = (
+    (90, 1.0, 0.0),
+    (75, 1.0, 0.0),
+    (50, 1.0, 0.0),
+    (50, 1.0, 0.2),
+    (40, 0.75, 0.33),
+    (35, 0.5, 0.5),
+    (30, 0.5, 1.0),
+)
+
+def start_level(quality_profile):
+    """The first adaptive level a quality profile allows."""
+    return next((i for i, level in enumerate(ADAPTIVE_LEVELS) if level[0] <= quality_profile['quality']), 0)
+
+MAX_FRAMES_IN_FLIGHT = 3 # Unacknowledged frames before a link counts as congested
+MAX_TRACKED_FRAMES = 32
+SEND_BACKLOG_LIMIT = 512 * 1024 # Kernel send-buffer bytes tolerated for students that don't ack
+RTT_CONGESTION_FLOOR = 0.25 # Seconds; round trips below this are never treated as congestion
+DOWNGRADE_HOLD = 1.0 # Seconds to let the queue drain after a downgrade before judging again
+UPGRADE_HOLD = 4.0 # Seconds a link has to stay healthy before stepping back up
+LATENCY_SAMPLES = 4096 # Capture-to-ack latencies kept per client for percentiles
+CLIENT_MESSAGE = struct.Struct(">cI") # kind, value
+CLIENT_MSG_ACK = b'A' # value: number of messages the student has finished handling
+CLIENT_MSG_MULTICAST = b'M' # value: 1 once receiving from the multicast group, 0 when falling back to TCP
+CLIENT_MSG_KEYFRAME = b'K' # value unused; the student lost sync and needs a keyframe
+CLIENT_MSG_STATS = b'S' # value: size of the STUDENT_STATS record that follows
+CLIENT_MSG_HELLO = b'H' # value: size of the HELLO record that follows; only ever the first message
+CLIENT_MSG_VIEWPORT = b'V' # value: size of the VIEWPORT record that follows; sent whenever the stream window is resized
+VIEWPORT = struct.Struct(">HH") # stream window width, height
+CLIENT_MSG_ROSTER = b'R' # value: size of the ROSTER that follows; relays send it whenever a viewer joins or leaves
+# Capture time of the last frame shown, ms since it was shown, displayed fps, receive/decode/resize/display ms, frames dropped
+STUDENT_STATS = struct.Struct(">dffffffI")
+
+def socket_send_backlog(connection):
+    """Returns the bytes still queued in the kernel send buffer, or None where the OS can't report it."""
+    try:
+        import fcntl, termios
+        return struct.unpack("I", fcntl.ioctl(connection.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+    except (ImportError, AttributeError, OSError):
+        return None
+
+class AdaptiveController:
+    """Per-connection congestion controller for quality, resolution scale and frame interval.
+
+    It watches send throughput, the socket send-buffer backlog and round-trip frame acks, and moves the
+    client along ADAPTIVE_LEVELS. The selected quality profile is both the starting point and the cap.
+    """
+    def __init__(self, quality_profile):
+        self.base_delay = motion_capture_interval(quality_profile['delay']) # Never slower than the capture loop at its fastest
+        self.start_level = start_level(quality_profile)
+        self.level = self.start_level
+        self._lock = threading.Lock()
+        self.window_opened = asyncio.Event()
+        self._in_flight = {} # frame number -> (send time, size, capture time)
+        self.frames_sent = 0
+        self.frames_acked = 0
+        self.acks_supported = False
+        self.rtt = None
+        self.min_rtt = None
+        self.latency = None # Seconds from screen capture until the student acked the frame
+        self.latency_samples = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.fps = 0.0
+        self.throughput = 0.0 # bytes per second
+        self._window_start = time.time()
+        self._window_frames = 0
+        self._window_bytes = 0
+        self._last_change = time.time()
+        self._healthy_since = time.time()
+
+    @property
+    def quality(self): return ADAPTIVE_LEVELS[self.level][0]
+    @property
+    def scale(self): return ADAPTIVE_LEVELS[self.level][1]
+    @property
+    def frame_interval(self): return max(self.base_delay, ADAPTIVE_LEVELS[self.level][2])
+
+    def on_send(self, size, captured_at=None):
+        with self._lock:
+            self.frames_sent += 1
+            self._in_flight[self.frames_sent] = (time.time(), size, captured_at)
+            if len(self._in_flight) > MAX_TRACKED_FRAMES: # Students that never ack must not grow this forever
+                del self._in_flight[next(iter(self._in_flight))]
+            if not self.acks_supported:
+                self._count(size)
+
+    def on_ack(self, frames_displayed):
+        now = time.time()
+        with self._lock:
+            self.acks_supported = True
+            for frame_number in [n for n in self._in_flight if n <= frames_displayed]:
+                sent_at, size, captured_at = self._in_flight.pop(frame_number)
+                self._count(size)
+                if captured_at is not None:
+                    self.latency = now - captured_at
+                    self.latency_samples.append(self.latency)
+                if frame_number == frames_displayed:
+                    self.rtt = now - sent_at
+                    self.min_rtt = self.rtt if self.min_rtt is None else min(self.min_rtt, self.rtt)
+            self.frames_acked = max(self.frames_acked, frames_displayed)
+        self.window_opened.set()
+
+    def has_window(self, backlog):
+        """True when the link has room for another frame: acked students by frames in flight, others by backlog."""
+        with self._lock:
+            if self.acks_supported:
+                return len(self._in_flight) < MAX_FRAMES_IN_FLIGHT
+        return backlog is None or backlog <= SEND_BACKLOG_LIMIT
+
+    def _count(self, size):
+        self._window_frames += 1
+        self._window_bytes += size
+        elapsed = time.time() - self._window_start
+        if elapsed >= 1.0:
+            self.fps = self._window_frames / elapsed
+            self.throughput = self._window_bytes / elapsed
+            self._window_start, self._window_frames, self._window_bytes = time.time(), 0, 0
+
+    def is_congested(self, backlog):
+        with self._lock:
+            if self.acks_supported and len(self._in_flight) > MAX_FRAMES_IN_FLIGHT:
+                return True
+            if self.rtt is not None and self.rtt > max(RTT_CONGESTION_FLOOR, 3 * self.min_rtt):
+                return True
+            if backlog is not None and self._in_flight:
+                average_size = sum(entry[1] for entry in self._in_flight.values()) / len(self._in_flight)
+                return backlog > 2 * average_size
+            return False
+
+    def update(self, backlog, overloaded=False):
+        """Re-evaluates the link; returns True when the level (and so the rendition) changed.
+
+        overloaded reports a student that can't decode what it gets in time, which is handled like congestion.
+        """
+        now = time.time()
+        if overloaded or self.is_congested(backlog):
+            self._healthy_since = now
+            if self.level < len(ADAPTIVE_LEVELS) - 1 and now - self._last_change >= DOWNGRADE_HOLD:
+                self.level += 1
+                self._last_change = now
+                return True
+        elif self.level > self.start_level and now - max(self._healthy_since, self._last_change) >= UPGRADE_HOLD:
+            self.level -= 1
+            self._last_change = self._healthy_since = now
+            return True
+        return False
+
+    def force_downgrade(self):
+        """Steps down one level immediately; returns False when already at the bottom of the ladder."""
+        if self.level >= len(ADAPTIVE_LEVELS) - 1:
+            return False
+        self.level += 1
+        self._last_change = self._healthy_since = time.time()
+        return True
+
+    def lower_ceiling(self):
+        """Teacher-requested downgrade: steps down one level and never climbs back above it; False at the bottom."""
+        if not self.force_downgrade():
+            return False
+        self.start_level = self.level
+        return True
+
+    def stats(self):
+        return {"quality": self.quality, "scale": self.scale, "fps": self.fps, "throughput": self.throughput, "rtt": self.rtt, "latency": self.latency}
+
+# --- Metrics ---
+METRICS_LOG_PATH = os.environ.get("INSIGHTLINK_METRICS_LOG") # e.g. teacher_metrics.log; one JSON line per student per second
+METRICS_LOG_MAX_BYTES = 5 * 1024 * 1024
+METRICS_LOG_BACKUPS = 3
+STAGE_SMOOTHING = 0.2 # Weight of the newest sample in the per-stage moving averages
+
+class StageTimings:
+    """Moving averages, in milliseconds, of how long each pipeline stage takes."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ms = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            previous = self._ms.get(stage)
+            self._ms[stage] = seconds * 1000 if previous is None else previous + STAGE_SMOOTHING * (seconds * 1000 - previous)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: round(ms, 2) for stage, ms in self._ms.items()}
+
+def open_metrics_log(path=METRICS_LOG_PATH):
+    """Returns a logger writing JSON lines to a size-rotated file, or None when metrics logging is off."""
+    if not path:
+        return None
+    logger = logging.getLogger("insightlink.metrics")
+    if not logger.handlers:
+        try:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=METRICS_LOG_MAX_BYTES, backupCount=METRICS_LOG_BACKUPS)
+        except OSError as e:
+            print(f"Warning: Could not open metrics log '{path}' ({e}). Metrics will not be logged.")
+            return None
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+def log_metrics(logger, record):
+    if logger is not None:
+        logger.info(json.dumps(dict(record, time=round(time.time(), 3))))
+
+# --- Relays ---
+# Students started with INSIGHTLINK_RELAY_PORT re-serve the stream to others. A relay is sent unstamped frames plus
+# each viewer's watermark, which the teacher still authors; the relay burns every viewer's stamp into band tiles of
+# that viewer's stream and draws its own, so viewers get stamped pixels and draw nothing themselves.
+# Once RELAY_DIRECT_LIMIT viewers are served directly, joiners are redirected to the least-loaded relay.
+REDIRECT = struct.Struct(">4sH") # relay IPv4 address, port
+ROSTER = struct.Struct(">HH") # capacity, viewer count; followed by one ROSTER_ENTRY per viewer
+ROSTER_ENTRY = struct.Struct(">4sH") # viewer IPv4 address, port
+RELAY_MAX_CAPACITY = 64
+RELAY_DIRECT_LIMIT = int(os.environ.get("INSIGHTLINK_DIRECT_VIEWERS", 8)) # Viewers the teacher serves itself before using relays
+
+def pack_roster_entry(address):
+    ip, port = address.rsplit(':', 1)
+    return ROSTER_ENTRY.pack(socket.inet_aton(ip), int(port))
+
+def unpack_roster(data):
+    """Parses a ROSTER into (capacity, ["ip:port", ...])."""
+    capacity, count = ROSTER.unpack_from(data)
+    entries = (ROSTER_ENTRY.unpack_from(data, ROSTER.size + index * ROSTER_ENTRY.size) for index in range(count))
+    return capacity, [f"{socket.inet_ntoa(ip)}:{port}" for ip, port in entries]
+
+# --- Client Sessions ---
+RENDITION_SCALES = (1.0, 0.75, 0.5, 0.375, 0.25) # Size buckets: students whose windows fall in the same one share its encodes
+LAG_DOWNGRADE_AFTER = 3.0 # Seconds a client may keep dropping frames before it is forced down a level
+LAG_DISCONNECT_AFTER = 30.0 # Seconds at the lowest level, still dropping frames, before the client is disconnected
+WRITE_BUFFER_HIGH = 1024 * 1024 # asyncio transport watermarks: above HIGH the client is behind and writes pause
+WRITE_BUFFER_LOW = 256 * 1024
+PAYLOAD_WORKERS = min(8, os.cpu_count() or 1)
+
+class ClientSession:
+    """Everything the server tracks for one connected student: its stream writer, controller, rendition and send state."""
+    def __init__(self, writer, address, quality_profile, watermarker):
+        self.writer = writer
+        self.address = address
+        self.controller = AdaptiveController(quality_profile)
+        self.watermark = ViewerWatermark(watermarker, address.split(':')[0])
+        self.task = None
+        self.rendition = None
+        self.sent_seq = 0 # Rendition sequence number of the newest payload written for this client
+        self.frames_dropped = 0 # Published while the client's link was full, and superseded before it had room
+        self.frames_skipped = 0 # Published between sends because of the client's frame interval
+        self.behind_since = None
+        self.close_reason = None
+        self.multicast = False # Receiving pixels from the multicast group; TCP only carries its watermark
+        self.timings = StageTimings() # watermark and send stages for this client
+        self.student_stats = None # Latest report from the student itself
+        self.version = 1 # Until a v2 hello arrives
+        self.codecs = CODEC_JPEG
+        self.viewer_size = None # The student's stream window, (width, height); frames are sized to cover it
+        self.decode_budget = 0 # Milliseconds per frame the student can spend decoding; 0 = no limit
+        self.relay_port = 0 # Non-zero for a relay, which re-serves the stream on this port
+        self.relay_capacity = 0
+        self.downstream = {} # Relay viewers, "ip:port" -> ViewerWatermark
+        self.pending_joins = 0 # Joiners redirected here that haven't shown up in the roster yet
+
+    def apply_hello(self, hello):
+        magic, version, codecs, max_width, max_height, decode_budget, relay_port = hello
+        if magic != HELLO_MAGIC or version < 2:
+            raise ConnectionError("malformed hello")
+        self.version = min(version, PROTOCOL_VERSION)
+        self.codecs = codecs & TEACHER_CODECS or CODEC_ZLIB_RAW
+        self.set_viewer_size(max_width, max_height)
+        self.decode_budget = decode_budget
+        self.relay_port = relay_port
+
+    def set_viewer_size(self, width, height):
+        self.viewer_size = (width, height) if width and height else None
+
+    @property
+    def codec(self):
+        if self.version < 2 or self.relay_port:
+            return CODEC_JPEG # Every viewer behind a relay can decode JPEG
+        return choose_codec(self.codecs, self.controller.level)
+
+    def max_scale(self, screen_size):
+        """The smallest size bucket whose frames still cover the student's window, so it only ever scales down."""
+        if not self.viewer_size or not screen_size or self.relay_port: # A relay's viewers have windows of their own
+            return 1.0
+        fit = min(self.viewer_size[0] / screen_size[0], self.viewer_size[1] / screen_size[1])
+        return min((scale for scale in RENDITION_SCALES if scale >= fit), default=1.0)
+
+    def over_decode_budget(self):
+        if not self.decode_budget or not self.student_stats:
+            return False
+        stages = self.student_stats["stages"]
+        return stages["decode"] + stages["resize"] > self.decode_budget
+
+    def set_roster(self, capacity, viewers):
+        """Replaces a relay's viewer list; returns the (joined, left) addresses."""
+        joined = [address for address in viewers if address not in self.downstream]
+        left = [address for address in self.downstream if address not in viewers]
+        self.downstream = {address: self.downstream.get(address) or ViewerWatermark(self.watermark.watermarker, address.rsplit(':', 1)[0])
+                           for address in viewers}
+        self.relay_capacity = min(capacity, RELAY_MAX_CAPACITY)
+        self.pending_joins = max(0, self.pending_joins - len(joined))
+        return joined, left
+
+    def relay_load(self):
+        if not self.relay_capacity:
+            return 1.0 # No roster yet
+        return (len(self.downstream) + self.pending_joins) / self.relay_capacity
+
+    def send_backlog(self):
+        """Bytes written but not yet on the wire: the transport's buffer plus the kernel's, where available."""
+        kernel_backlog = socket_send_backlog(self.writer.get_extra_info('socket'))
+        return self.writer.transport.get_write_buffer_size() + (kernel_backlog or 0)
+
+    def mark_behind(self):
+        if self.behind_since is None:
+            self.behind_since = time.time()
+
+    def on_student_stats(self, report):
+        """Stores a STUDENT_STATS report; latency is capture-to-display, measured on the teacher's clock."""
+        captured_at, age_ms, fps, receive_ms, decode_ms, resize_ms, display_ms, dropped = report
+        latency = None
+        if captured_at:
+            # The report left the student age_ms after the frame was shown and took about half a round trip to get here.
+            latency = max(0.0, time.time() - captured_at - age_ms / 1000 - (self.controller.rtt or 0) / 2)
+        stages = {"receive": receive_ms, "decode": decode_ms, "resize": resize_ms, "display": display_ms}
+        self.student_stats = {"fps": round(fps, 2), "latency": latency, "dropped": dropped,
+                              "stages": {stage: round(ms, 2) for stage, ms in stages.items()}}
+
+    def stats(self):
+        stats = self.controller.stats()
+        stats.update(dropped=self.frames_dropped, skipped=self.frames_skipped, multicast=self.multicast,
+                     stages=self.timings.snapshot(), student=self.student_stats, version=self.version,
+                     codec=CODEC_NAMES[self.rendition.codec] if self.rendition else None,
+                     relay_viewers=len(self.downstream) if self.relay_port else None, relay_capacity=self.relay_capacity)
+        if self.rendition:
+            stats["scale"] = self.rendition.scale # What is actually sent, after the window's size bucket
+        return stats
+
+# --- Roster ---
+# Every student the teacher can see, directly connected or behind a relay, indexed by "ip:port". The server updates it
+# from its own threads as often as it likes; the UI only picks up what changed, once every ROSTER_REFRESH_MS.
+ROSTER_JOINING = "joining" # Connected, handshake not finished
+ROSTER_WATCHING = "watching"
+ROSTER_VIA_RELAY = "via relay"
+ROSTER_REFRESH_MS = 500
+
+class RosterEntry:
+    """One student: its session (None behind a relay), the relay it watches through, its state and latest stats."""
+    def __init__(self, address, session=None, relay=None):
+        self.address = address
+        self.session = session
+        self.relay = relay
+        self.state = ROSTER_VIA_RELAY if relay else ROSTER_JOINING
+        self.stats = None # Replaced whole by every report, never modified, so the UI can read it without the lock
+
+class Roster:
+    """Address-indexed RosterEntry records plus the addresses changed since the UI last drained them.
+
+    It shares the server's clients_lock, so the UI never sees a student in the roster that the server has
+    already forgotten, or the other way round.
+    """
+    def __init__(self, lock):
+        self.lock = lock
+        self.entries = {}
+        self.changed = set()
+
+    def add(self, address, session=None, relay=None):
+        with self.lock:
+            self.entries[address] = RosterEntry(address, session, relay)
+            self.changed.add(address)
+
+    def remove(self, address):
+        with self.lock:
+            if self.entries.pop(address, None):
+                self.changed.add(address)
+
+    def clear(self):
+        with self.lock:
+            self.changed.update(self.entries)
+            self.entries.clear()
+
+    def get(self, address):
+        with self.lock:
+            return self.entries.get(address)
+
+    def set_state(self, address, state):
+        with self.lock:
+            if address in self.entries:
+                self.entries[address].state = state
+                self.changed.add(address)
+
+    def update_stats(self, address, stats):
+        with self.lock:
+            if address in self.entries:
+                self.entries[address].stats = stats
+                self.changed.add(address)
+
+    def drain(self):
+        """Returns {address: entry, or None once it has left} for every student changed since the last call."""
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            return {address: self.entries.get(address) for address in changed}
+
+def address_sort_key(address):
+    """Sorts "ip:port" numerically, so 10.0.0.9 comes before 10.0.0.10."""
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part) for part in re.split(r"[.:]", address)]
+
+def roster_row(entry):
+    """The Student Management columns for one entry: the texts shown, and the values each column sorts by."""
+    stats = entry.stats
+    if entry.relay:
+        return (f"  ↳ {entry.address}", "via relay", "-", "-", "-", "-"), (address_sort_key(entry.address), -1, -1, -1, -1, -1)
+    if stats is None:
+        return (entry.address, "joining..." if entry.state == ROSTER_JOINING else "-", "-", "-", "-", "-"), (address_sort_key(entry.address), -1, -1, -1, -1, -1)
+    quality = "Multicast" if stats['multicast'] else f"Q{stats['quality']} @ {stats['scale']:.0%}"
+    if stats['relay_viewers'] is not None:
+        quality = f"Relay {stats['relay_viewers']}/{stats['relay_capacity']}"
+    elif stats['version'] < 2:
+        quality += " (v1)"
+    elif stats['codec'] and stats['codec'] != "JPEG":
+        quality += f" {stats['codec']}"
+    # Prefer what the student reports it actually displayed over what was sent/acked.
+    student = stats['student'] or {}
+    fps = student.get('fps', stats['fps'])
+    latency = student.get('latency') or stats['latency']
+    latency_text = f"{latency * 1000:.0f} ms" if latency is not None else "-"
+    dropped = stats['dropped'] + stats['skipped']
+    texts = (entry.address, quality, f"{fps:.1f}", latency_text, f"{stats['throughput'] * 8 / 1000:.0f} kbps", dropped)
+    return texts, (address_sort_key(entry.address), stats['quality'] * stats['scale'], fps, -1 if latency is None else latency, stats['throughput'], dropped)
+
+# --- Multicast Broadcast ---
+MULTICAST_GROUP = '239.255.42.99'
+MULTICAST_PORT = 9998
+MULTICAST_TTL = 1 # Never leave the classroom subnet
+MULTICAST_INTERFACE = os.environ.get("INSIGHTLINK_MULTICAST_IF", "0.0.0.0") # e.g. 127.0.0.1 to test on one machine
+MULTICAST_CHUNK_SIZE = 1200 # Payload bytes per datagram, keeping packets under a 1500-byte Ethernet MTU
+FEC_GROUP_SIZE = 8 # One XOR parity datagram per this many data datagrams; repairs one loss per group
+MULTICAST_PACING_BURST = 32 # Datagrams sent back to back before briefly yielding, so keyframes don't flood switch buffers
+MULTICAST_KEEPALIVE_INTERVAL = 2.0 # Seconds without a broadcast before an empty keepalive is sent
+MULTICAST_PACKET_MAGIC = b'ILMP'
+MULTICAST_PACKET_HEADER = struct.Struct(">4sIIHHB") # magic, broadcast seq, payload length, index, data packet count, kind
+PACKET_KIND_DATA = 0
+PACKET_KIND_PARITY = 1 # index is the FEC group number
+MULTICAST_ANNOUNCE_MAGIC = b'ILMA'
+MULTICAST_ANNOUNCE = struct.Struct(">4s4sH") # magic, group address, port
+WATERMARK_META_MAGIC = b'ILWM'
+WATERMARK_META_HEADER = struct.Struct(">4sHHHB") # magic, x, y, font size, alpha; followed by the UTF-8 text
+KEYFRAME_REQUEST_MIN_INTERVAL = 1.0 # Seconds between keyframes forced by student requests
+
+def packetize_frame(broadcast_seq, payload, chunk_size=MULTICAST_CHUNK_SIZE, group_size=FEC_GROUP_SIZE):
+    """Splits a payload into numbered datagrams, following each FEC group with its XOR parity datagram."""
+    chunks = [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)] or [b'']
+    packets = []
+    for group_start in range(0, len(chunks), group_size):
+        parity = 0
+        for index in range(group_start, min(group_start + group_size, len(chunks))):
+            packets.append(MULTICAST_PACKET_HEADER.pack(MULTICAST_PACKET_MAGIC, broadcast_seq, len(payload), index, len(chunks), PACKET_KIND_DATA) + chunks[index])
+            parity ^= int.from_bytes(chunks[index].ljust(chunk_size, b'\0'), 'big')
+        header = MULTICAST_PACKET_HEADER.pack(MULTICAST_PACKET_MAGIC, broadcast_seq, len(payload), group_start // group_size, len(chunks), PACKET_KIND_PARITY)
+        packets.append(header + parity.to_bytes(chunk_size, 'big'))
+    return packets
+
+class MulticastSender:
+    """Sends each frame payload once to the multicast group, so teacher bandwidth no longer grows with class size."""
+    def __init__(self, group=MULTICAST_GROUP, port=MULTICAST_PORT, interface=MULTICAST_INTERFACE):
+        self.address = (group, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface != '0.0.0.0':
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.broadcast_seq = 0
+        self.bytes_sent = 0
+
+    def announcement(self):
+        return MULTICAST_ANNOUNCE.pack(MULTICAST_ANNOUNCE_MAGIC, socket.inet_aton(self.address[0]), self.address[1])
+
+    def send_frame(self, payload):
+        self.broadcast_seq += 1
+        for count, packet in enumerate(packetize_frame(self.broadcast_seq, payload), 1):
+            self.sock.sendto(packet, self.address)
+            self.bytes_sent += len(packet)
+            if count % MULTICAST_PACING_BURST == 0:
+                time.sleep(0.0005)
+
+    def close(self):
+        self.sock.close()
+
+# --- Recording ---
+# A recording is a series of segment files, each a file header followed by the v2 messages of the shared
+# (un-watermarked) stream exactly as students would receive them, plus an index file of fixed-size entries.
+RECORD_DIR = os.environ.get("INSIGHTLINK_RECORD_DIR", "recordings")
+RECORD_MAGIC = b'ILRC'
+RECORD_VERSION = 1
+RECORD_HEADER = struct.Struct(">4sBd") # magic, format version, segment start time
+RECORD_INDEX_ENTRY = struct.Struct(">dIB") # capture timestamp, offset of the message in the segment, flags
+RECORD_FLAG_KEYFRAME = 0x01
+RECORD_SUFFIX = ".ilrec"
+RECORD_INDEX_SUFFIX = ".ilidx"
+RECORD_SEGMENT_BYTES = 512 * 1024 * 1024 # A segment is closed at the first keyframe once it is this big...
+RECORD_SEGMENT_SECONDS = 600 # ...or this old, so every segment starts with a keyframe and plays on its own
+
+class SessionRecorder:
+    """Appends already-encoded messages to segment files and their timestamp->offset indexes."""
+    def __init__(self, directory=None):
+        directory = directory or RECORD_DIR
+        os.makedirs(directory, exist_ok=True)
+        self.base = os.path.join(directory, time.strftime("lecture-%Y%m%d-%H%M%S"))
+        self.segment = 0
+        self.data = self.index = None
+        self.segment_started = 0
+        self.messages = 0
+
+    def append(self, msg_type, body, captured_at, keyframe):
+        """Writes one message; returns False while a keyframe is needed to start the next segment."""
+        due = self.data is None or self.data.tell() >= RECORD_SEGMENT_BYTES or time.time() - self.segment_started >= RECORD_SEGMENT_SECONDS
+        if due and keyframe:
+            self._open_segment()
+        elif self.data is None:
+            return False # A delta can't open a segment
+        offset = self.data.tell()
+        self.data.write(MESSAGE_HEADER.pack(msg_type, len(body)))
+        self.data.write(body)
+        self.index.write(RECORD_INDEX_ENTRY.pack(captured_at, offset, RECORD_FLAG_KEYFRAME if keyframe else 0))
+        self.messages += 1
+        return keyframe or not due
+
+    def _open_segment(self):
+        self.close()
+        self.segment += 1
+        path = f"{self.base}-{self.segment:03d}"
+        self.data = open(path + RECORD_SUFFIX, "wb")
+        self.index = open(path + RECORD_INDEX_SUFFIX, "wb")
+        self.segment_started = time.time()
+        self.data.write(RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, self.segment_started))
+        print(f"[RECORDING] Writing {path}{RECORD_SUFFIX}")
+
+    def close(self):
+        for handle in (self.data, self.index):
+            if handle:
+                handle.close()
+        self.data = self.index = None
+
+# --- Watermarking ---
+WATERMARK_FILL_ALPHA = 128
+
+@functools.lru_cache(maxsize=8)
+def load_watermark_font(size):
+    """Loads the watermark font once per size; a missing font is reported once instead of every frame."""
+    try:
+        return ImageFont.truetype(WATERMARK_FONT_PATH, size)
+    except IOError:
+        print(f"Warning: Could not load '{WATERMARK_FONT_PATH}'. Using default font.")
+        return ImageFont.load_default()
+
+class Watermarker:
+    """Shared watermark renderer: text overlays are drawn once and reused until the timestamp's second changes."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._overlays = {}
+        self._overlay_second = None
+
+    def text_for(self, viewer_ip):
+        return f"VIEWER: {viewer_ip} | {time.strftime('%Y-%m-%d %H:%M:%S')}"
+
+    def overlay(self, text, image_size, full_width):
+        """Returns (band_box, alpha_mask) for a watermark text, rendering it only on first use this second."""
+        key = (text, image_size, full_width)
+        with self._lock:
+            if self._overlay_second != int(time.time()):
+                self._overlays.clear()
+                self._overlay_second = int(time.time())
+            cached = self._overlays.get(key)
+        if cached:
+            return cached
+
+        font = load_watermark_font(max(12, int(image_size[1] * 0.03)))
+        _, _, text_right, text_bottom = font.getbbox(text)
+        band_height = min(image_size[1], align_up(WATERMARK_MARGIN + text_bottom, JPEG_MCU_HEIGHT))
+        band_width = image_size[0] if full_width else min(image_size[0], align_up(WATERMARK_MARGIN * 2 + text_right, JPEG_MCU_HEIGHT))
+        mask = Image.new("L", (band_width, band_height))
+        ImageDraw.Draw(mask).text((WATERMARK_MARGIN, WATERMARK_MARGIN), text, font=font, fill=WATERMARK_FILL_ALPHA)
+        cached = ((0, 0, band_width, band_height), mask)
+        with self._lock:
+            self._overlays[key] = cached
+        return cached
+
+class ViewerWatermark:
+    """Per-viewer stamp: re-encodes only the MCU-aligned band under the text, and only when it actually changes."""
+    def __init__(self, watermarker, viewer_ip):
+        self.watermarker = watermarker
+        self.viewer_ip = viewer_ip
+        self._sent_text = None
+        self._band_key = None
+        self._band_data = None
+
+    def is_stale(self):
+        return self.watermarker.text_for(self.viewer_ip) != self._sent_text
+
+    def invalidate(self):
+        """Forgets what was sent, e.g. after a payload carrying the band was dropped before reaching the client."""
+        self._sent_text = None
+
+    def metadata(self, image_size):
+        """Watermark description for viewers that get shared pixels (multicast) and draw the stamp themselves."""
+        text = self.watermarker.text_for(self.viewer_ip)
+        font_size = max(12, int(image_size[1] * 0.03))
+        self._sent_text = text
+        return WATERMARK_META_HEADER.pack(WATERMARK_META_MAGIC, WATERMARK_MARGIN, WATERMARK_MARGIN, font_size, WATERMARK_FILL_ALPHA) + text.encode('utf-8')
+
+    def _encode_band(self, image, quality, full_width, codec=CODEC_JPEG):
+        text = self.watermarker.text_for(self.viewer_ip)
+        box, mask = self.watermarker.overlay(text, image.size, full_width)
+        band = image.crop(box)
+        band_key = (text, quality, codec, box, band.tobytes())
+        if band_key != self._band_key:
+            band.paste((255, 255, 255), (0, 0), mask)
+            self._band_key = band_key
+            self._band_data = encode_tile(band, quality, codec, restart_markers=full_width)
+        self._sent_text = text
+        return box, self._band_data
+
+    def stamp_frame(self, frame, codec=CODEC_JPEG):
+        """Splices the viewer's band into a full frame's shared JPEG; other codecs are stamped and encoded whole."""
+        if codec == CODEC_JPEG:
+            frame.ensure_jpeg()
+        if codec != CODEC_JPEG or not frame.spliceable:
+            stamped = frame.image.copy()
+            text = self.watermarker.text_for(self.viewer_ip)
+            box, mask = self.watermarker.overlay(text, stamped.size, True)
+            stamped.paste((255, 255, 255), box[:2], mask)
+            self._sent_text = text
+            return encode_image(stamped, frame.quality, codec)
+        _, (_, band_jpeg) = self._encode_band(frame.image, frame.quality, full_width=True)
+        return splice_jpeg_rows(frame.header, frame.intervals, split_jpeg_scan(band_jpeg)[1])
+
+    def band_tile(self, frame, tiles, force=False, codec=CODEC_JPEG):
+        """Returns the band tile a delta-mode client needs on top of `tiles`, or None if its copy is still current."""
+        text = self.watermarker.text_for(self.viewer_ip)
+        box, _ = self.watermarker.overlay(text, frame.image.size, False)
+        # The band has to be re-sent whenever a shared tile lands on top of it.
+        if not force and text == self._sent_text and not any(tile.intersects(box) for tile in tiles):
+            return None
+        box, (band_codec, band_data) = self._encode_band(frame.image, frame.quality, full_width=False, codec=codec)
+        return Tile(box, band_data, codec=band_codec)
+
+# --- Screen Capture ---
+# A capture target is a (left, top, width, height) region in screen coordinates, or None for the primary monitor.
+CAPTURE_MIN_SIZE = 64 # Smallest region side worth sharing; also stops a stray click from selecting a sliver
+CAPTURE_CHOICE_DRAG = "Drag to select a region..."
+CAPTURE_CHOICE_FIXED = "Enter a fixed region..."
+REGION_REGEX = re.compile(r"^\s*(-?\d+)\s*,\s*(-?\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*$")
+
+def list_monitors():
+    """Every monitor's region, as mss numbers them: 0 is the bounding box of all of them, 1 the primary."""
+    with mss.mss() as sct:
+        return [(monitor["left"], monitor["top"], monitor["width"], monitor["height"]) for monitor in sct.monitors]
+
+def parse_region(text):
+    """Parses "left, top, width, height" into a region; raises ValueError if it isn't one."""
+    match = REGION_REGEX.match(text)
+    if not match:
+        raise ValueError("expected left, top, width, height")
+    region = tuple(int(value) for value in match.groups())
+    if min(region[2:]) < CAPTURE_MIN_SIZE:
+        raise ValueError(f"a region must be at least {CAPTURE_MIN_SIZE}x{CAPTURE_MIN_SIZE} pixels")
+    return region
+
+def clip_region(region, bounds):
+    """The part of region inside bounds, or None if too little of it is."""
+    left, top = max(region[0], bounds[0]), max(region[1], bounds[1])
+    right = min(region[0] + region[2], bounds[0] + bounds[2])
+    bottom = min(region[1] + region[3], bounds[1] + bounds[3])
+    if right - left < CAPTURE_MIN_SIZE or bottom - top < CAPTURE_MIN_SIZE:
+        return None
+    return (left, top, right - left, bottom - top)
+
+class MssFrameSource:
+    """Grabs one area of the screen. Frame sources are created on the capture thread, as mss handles are thread-affine.
+
+    Anything with the same grab()/close() pair can stand in for it, e.g. the synthetic screens of the benchmark;
+    sources that also have select() can switch capture targets.
+    """
+    def __init__(self):
+        self.sct = mss.mss()
+        self.select(None)
+
+    def select(self, target):
+        """Grabs only target from now on; a target that is off screen falls back to the primary monitor."""
+        primary = self.sct.monitors[1]
+        primary = (primary["left"], primary["top"], primary["width"], primary["height"])
+        all_monitors = self.sct.monitors[0]
+        self.region = target and clip_region(target, (all_monitors["left"], all_monitors["top"], all_monitors["width"], all_monitors["height"]))
+        if self.region is None:
+            if target is not None:
+                print(f"Warning: Capture region {target} is off screen. Sharing the primary monitor instead.")
+            self.region = primary
+        self.monitor = dict(zip(("left", "top", "width", "height"), self.region))
+
+    def grab(self):
+        shot = self.sct.grab(self.monitor)
+        return Image.frombytes("RGB", shot.size, shot.bgra, "raw", "BGRX")
+
+    def close(self):
+        self.sct.close()
+
+# --- Pointer ---
+# The pointer is streamed apart from the frames, so pointing stays smooth however far the frame rate is throttled.
+# Tk reports its position on every platform; the shape can only be read on Windows and is an arrow elsewhere.
+CURSOR_POLL_MS = 16 # How often the app samples the pointer
+CURSOR_MIN_INTERVAL = 1 / 60 # Fastest pointer updates sent to one student
+WIN32_CURSOR_IDS = {32512: CURSOR_ARROW, 32513: CURSOR_IBEAM, 32514: CURSOR_WAIT, 32515: CURSOR_CROSS, 32649: CURSOR_HAND, 32650: CURSOR_WAIT}
+
+class Win32CursorInfo(ctypes.Structure):
+    _fields_ = [("size", ctypes.c_uint32), ("flags", ctypes.c_uint32), ("handle", ctypes.c_void_p), ("x", ctypes.c_long), ("y", ctypes.c_long)]
+
+@functools.lru_cache(maxsize=1)
+def win32_cursor_handles():
+    """Handle -> CURSOR_* id of the standard system cursors, which GetCursorInfo reports by handle."""
+    user32 = ctypes.windll.user32
+    user32.LoadCursorW.restype = ctypes.c_void_p
+    user32.LoadCursorW.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
+    return {user32.LoadCursorW(None, cursor_id): shape for cursor_id, shape in WIN32_CURSOR_IDS.items()}
+
+def pointer_shape():
+    """The system pointer's current CURSOR_* shape; always the arrow where the OS can't be asked."""
+    if sys.platform != "win32":
+        return CURSOR_ARROW
+    info = Win32CursorInfo(size=ctypes.sizeof(Win32CursorInfo))
+    if not ctypes.windll.user32.GetCursorInfo(ctypes.byref(info)):
+        return CURSOR_ARROW
+    if not info.flags & 0x1: # CURSOR_SHOWING
+        return CURSOR_HIDDEN
+    return win32_cursor_handles().get(info.handle, CURSOR_ARROW)
+
 class ScreenSharingServer:
-    """Manages all backend server logic: connections, streaming, and client handling."""
-    def __init__(self, app_instance):
+    """Manages all backend server logic: connections, streaming, and client handling.
+
+    All client I/O runs as coroutines on one asyncio event loop in a background thread; screen capture and
+    encoding are offloaded to executors. The Tk app talks to it through thread-safe methods and callbacks.
+    """
+    def __init__(self, app_instance, frame_source=MssFrameSource):
         self.app = app_instance
+        self.frame_source_factory = frame_source
         self.is_running = False
         self.is_paused = False
         self.clients = {}
         self.clients_lock = threading.Lock()
+        self.roster = Roster(self.clients_lock) # What the UI lists: self.clients plus every relay's viewers
+        self.loop = None
         self.server_thread = None
-        self.server_socket = None
+        self.server = None
+        self.capture_task = None
+        self.capture_executor = None
+        self.capture_scheduler = None
+        self.capture_target = None # Region to share, or None for the primary monitor; see set_capture_target
+        self.capture_target_changed = False
+        self.payload_executor = None
+        self.strip_encoder = None
+        self.frame_source = None
+        self.renditions = {}
+        self.watermarker = Watermarker()
         self.quality_profile = QUALITY_SETTINGS["Medium (Wi-Fi)"]
+        self.delta_mode = True
+        self.multicast_enabled = False
+        self.multicast_sender = None
+        self.multicast_task = None
+        self.multicast_executor = None
+        self.broadcast_rendition = None
+        self.record_enabled = False
+        self.recorder = None
+        self.record_task = None
+        self.record_executor = None
+        self.record_rendition = None
+        self.last_keyframe_request = 0
+        self.stage_timings = StageTimings() # grab and encode stages, shared by every client
+        self.screen_size = None
+        self.capture_region = None # (left, top, width, height) of the grabbed area, for placing the pointer
+        self.pointer = (0, 0, CURSOR_HIDDEN) # Latest (x, y, shape) from move_pointer
+        self.metrics_log = open_metrics_log()
 
-    def start(self, quality_profile_name):
+    def start(self, quality_profile_name, delta_mode=True, multicast=False, record=False):
         self.quality_profile = QUALITY_SETTINGS[quality_profile_name]
-        self.is_running = True
+        self.delta_mode = delta_mode
+        self.multicast_enabled = multicast
+        self.record_enabled = record
+        self.is_paused = False
+        self.renditions.clear()
+        self.loop = asyncio.new_event_loop()
+        self.server_thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.server_thread.start()
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.bind((HOST, PORT))
-            self.server_socket.listen()
+            asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
         except OSError:
+            self.loop.call_soon_threadsafe(self.loop.stop)
             self.app.show_error("Server Error", f"Port {PORT} is already in use.\nPlease close other applications and try again.")
-            self.is_running = False
             return False
         
-        self.server_thread = threading.Thread(target=self._listen_for_clients)
-        self.server_thread.daemon = True
-        self.server_thread.start()
+        self.is_running = True
         self.app.update_status(f"Server is LIVE on {get_local_ip()}:{PORT}")
         return True
 
     def stop(self):
         self.is_running = False
-        if self.server_socket:
-            # Unblock the server socket accept() call
+        if self.loop and self.loop.is_running():
             try:
-                socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((get_local_ip(), PORT))
-            except:
-                pass
-            self.server_socket.close()
-
-        with self.clients_lock:
-            for conn in self.clients.values():
-                conn.close()
-            self.clients.clear()
+                asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=5)
+            except Exception as e:
+                print(f"Warning: Server did not shut down cleanly: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
         
         self.app.update_status("Server stopped. Ready to start a new session.")
-        self.app.clear_client_list()
+        self.roster.clear()
 
     def toggle_pause(self):
         self.is_paused = not self.is_paused
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.resumed.clear if self.is_paused else self.resumed.set)
         status = "paused" if self.is_paused else "resumed"
         self.app.update_status(f"Streaming {status}.")
         return self.is_paused
 
-    def kick_client(self, client_address):
+    def _loop_running(self):
+        """True while UI calls may still post work to the server's event loop."""
+        return self.is_running and self.loop is not None and self.loop.is_running()
+
+    def kick_clients(self, addresses):
+        """Disconnects students; one watching through a relay is dropped by that relay instead."""
+        if not self._loop_running():
+            return # Everyone was already disconnected when the server stopped
+        for address in addresses:
+            entry = self.roster.get(address)
+            relay = entry and entry.relay and self.roster.get(entry.relay)
+            if entry and entry.session and entry.session.task:
+                entry.session.close_reason = "kicked by teacher"
+                self.loop.call_soon_threadsafe(entry.session.task.cancel)
+            elif relay and relay.session:
+                asyncio.run_coroutine_threadsafe(self._write_message(relay.session, MSG_RELAY_KICK, pack_roster_entry(address)), self.loop)
+
+    def downgrade_clients(self, addresses):
+        """Lowers the quality of directly connected students by one level for the rest of their session; returns how many."""
+        if not self._loop_running():
+            return 0
+        sessions = [entry.session for entry in map(self.roster.get, addresses) if entry and entry.session]
+        def lower():
+            for session in sessions:
+                session.controller.lower_ceiling()
+        if sessions:
+            self.loop.call_soon_threadsafe(lower)
+        return len(sessions)
+
+    def set_capture_target(self, region):
+        """Shares another region, or the primary monitor for None; a running session switches at its next grab."""
+        self.capture_target = region
+        self.capture_target_changed = True
+
+    def move_pointer(self, x, y, shape=CURSOR_ARROW):
+        """Takes the pointer's screen position from the app; v3 students get it from _stream_cursor."""
+        if (x, y, shape) == self.pointer:
+            return
+        self.pointer = (x, y, shape)
+        if self._loop_running():
+            self.loop.call_soon_threadsafe(self._pointer_moved)
+
+    def _pointer_moved(self):
+        self.pointer_changed.set()
+        self.pointer_changed = asyncio.Event()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def _open(self):
+        """Binds the listening socket and starts the capture task; runs on the event loop."""
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.frame_published = asyncio.Event()
+        self.pointer_changed = asyncio.Event()
+        self.server = await asyncio.start_server(self._handle_client, HOST, PORT)
+        # mss handles are tied to the thread that created them, so capture always runs on one dedicated thread.
+        self.capture_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+        self.payload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PAYLOAD_WORKERS, thread_name_prefix="payload")
+        self.strip_encoder = StripEncoder()
+        self.capture_scheduler = CaptureScheduler(self.quality_profile['delay'], recheck=self.delta_mode)
+        self.capture_task = asyncio.get_running_loop().create_task(self._capture_loop())
+        if self.multicast_enabled:
+            self._open_multicast()
+        if self.record_enabled:
+            self._open_recording()
+
+    def _open_multicast(self):
+        try:
+            self.multicast_sender = MulticastSender()
+        except OSError as e:
+            print(f"Warning: Multicast is unavailable ({e}); streaming to every student over TCP.")
+            self.multicast_enabled = False
+            return
+        self.broadcast_rendition = self._acquire_rendition(self.quality_profile['quality'], 1.0)
+        self.multicast_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="multicast")
+        self.multicast_task = asyncio.get_running_loop().create_task(self._multicast_loop())
+
+    def _open_recording(self):
+        try:
+            self.recorder = SessionRecorder()
+        except OSError as e:
+            print(f"Warning: Cannot record to '{RECORD_DIR}' ({e}). The session will not be recorded.")
+            self.app.show_error("Recording Error", f"Cannot record to '{RECORD_DIR}':\n{e}")
+            return
+        # The full-quality rendition in the codec a current student gets at that level, so it is shared with any student
+        # watching there and often costs no encode at all. Relays and older students stay on JPEG renditions of their own.
+        quality = self.quality_profile['quality']
+        codec = choose_codec(TEACHER_CODECS, start_level(self.quality_profile)) if self.delta_mode else CODEC_JPEG
+        self.record_rendition = self._acquire_rendition(quality, 1.0, codec)
+        self.record_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="record")
+        self.record_task = asyncio.get_running_loop().create_task(self._record_loop())
+
+    async def _shutdown(self):
+        """Closes the listener and cancels every client and the capture task; the clean path for stop()."""
+        self.server.close()
         with self.clients_lock:
-            if client_address in self.clients:
-                self.clients[client_address].close()
+            tasks = [session.task for session in self.clients.values() if session.task]
+        background = [task for task in (self.capture_task, self.multicast_task, self.record_task) if task]
+        for task in tasks + background:
+            task.cancel()
+        await asyncio.gather(*tasks, *background, return_exceptions=True)
+        await self.server.wait_closed()
+        await asyncio.get_running_loop().run_in_executor(self.capture_executor, self._close_capture)
+        self.capture_executor.shutdown(wait=False)
+        self.payload_executor.shutdown(wait=False)
+        self.strip_encoder.close()
+        if self.multicast_sender:
+            self.multicast_executor.shutdown(wait=True)
+            self.multicast_sender.close()
+            self.multicast_sender = self.multicast_task = self.broadcast_rendition = None
+        if self.recorder:
+            self.record_executor.shutdown(wait=True) # Lets a write in progress finish before the files close
+            self.recorder.close()
+            print(f"[RECORDING] Saved {self.recorder.messages} messages in {self.recorder.segment} segment(s) to {self.recorder.base}-*{RECORD_SUFFIX}")
+            self.recorder = self.record_task = self.record_rendition = None
+
+    def _acquire_rendition(self, quality, scale, codec=CODEC_JPEG):
+        rendition = self.renditions.get((quality, scale, codec))
+        if rendition is None:
+            rendition = self.renditions[(quality, scale, codec)] = Rendition(quality, scale, codec)
+        rendition.subscribers += 1
+        return rendition
+
+    def _release_rendition(self, rendition):
+        rendition.subscribers -= 1
+        if rendition.subscribers <= 0:
+            self.renditions.pop((rendition.quality, rendition.scale, rendition.codec), None)
+
+    async def _capture_loop(self):
+        """Single producer: grabs each screen frame once and encodes it once per rendition in use, paced by the scheduler."""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self.resumed.wait()
+                renditions = list(self.renditions.values())
+                if not renditions:
+                    await asyncio.sleep(0.1)
+                    continue
+
+                started = time.time()
+                if await loop.run_in_executor(self.capture_executor, self._capture_and_encode, renditions):
+                    # Wake every client waiting for a frame, then arm a fresh event for the next one.
+                    self.frame_published.set()
+                    self.frame_published = asyncio.Event()
+                await asyncio.sleep(max(0, started + self.capture_scheduler.interval - time.time()))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error: Screen capture failed: {e}")
+            self.app.update_status(f"Screen capture failed: {e}")
+
+    def _capture_and_encode(self, renditions):
+        """Grabs the screen; an unchanged grab is only encoded for renditions that need a frame. Returns True if any did."""
+        if self.frame_source is None:
+            self.frame_source = self.frame_source_factory()
+            self.capture_target_changed = True
+        if self.capture_target_changed and hasattr(self.frame_source, "select"):
+            # A new size reaches students as a keyframe, so nobody has to reconnect.
+            self.capture_target_changed = False
+            self.frame_source.select(self.capture_target)
+        captured_at = time.time()
+        with self.stage_timings.measure("grab"):
+            pil_img = self.frame_source.grab()
+        self.screen_size = pil_img.size
+        self.capture_region = getattr(self.frame_source, "region", (0, 0) + pil_img.size)
+        with self.stage_timings.measure("detect"):
+            changed = self.capture_scheduler.observe(pil_img)
+        if not changed:
+            renditions = [rendition for rendition in renditions if rendition.needs_encode()]
+            if not renditions:
+                return False
+        with self.stage_timings.measure("encode"):
+            for rendition in renditions:
+                rendition.encode(pil_img, self.delta_mode, self.strip_encoder, captured_at)
+        return True
+
+    def _close_capture(self):
+        if self.frame_source is not None:
+            self.frame_source.close()
+            self.frame_source = None
+
+    async def _multicast_loop(self):
+        """Sends the shared broadcast rendition to the multicast group once, however many students have joined."""
+        loop = asyncio.get_running_loop()
+        rendition, last_seq, last_sent = self.broadcast_rendition, 0, time.time()
+        keepalive = MESSAGE_HEADER.pack(MSG_KEEPALIVE, 0)
+        while True:
+            await self.resumed.wait()
+            frame_published = self.frame_published
+            has_viewers = any(session.multicast for session in list(self.clients.values()))
+            if not has_viewers or rendition.frame_buffer.seq <= last_seq:
+                if has_viewers and time.time() - last_sent >= MULTICAST_KEEPALIVE_INTERVAL: # Idle screen: prove the group is alive
+                    await loop.run_in_executor(self.multicast_executor, self.multicast_sender.send_frame, keepalive)
+                    last_sent = time.time()
+                try:
+                    await asyncio.wait_for(frame_published.wait(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            last_seq = await loop.run_in_executor(self.multicast_executor, self._broadcast_frame, rendition, last_seq)
+            last_sent = time.time()
+
+    def _shared_message(self, rendition, since_seq):
+        """The un-watermarked message catching a viewer up from since_seq: (frame, message type, body, is keyframe).
+
+        Shared by everything that carries the stream without a per-viewer band: multicast, relays and recording.
+        """
+        if self.delta_mode:
+            frame, is_keyframe, tiles = rendition.frame_buffer.collect_tiles(since_seq)
+            return frame, MSG_TILES, pack_tile_frame(frame.seq, frame.image.size, tiles, keyframe=is_keyframe, captured_at=frame.captured_at), is_keyframe
+        frame = rendition.frame_buffer.frame
+        return frame, MSG_FRAME, pack_frame(frame, CODEC_JPEG, frame.ensure_jpeg()), True
+
+    def _broadcast_frame(self, rendition, since_seq):
+        """Runs on the multicast executor; the broadcast carries no per-viewer band, viewers draw it from metadata."""
+        frame, msg_type, body, _ = self._shared_message(rendition, since_seq)
+        # Each broadcast payload is a complete v2 message, so students handle it exactly like one read from TCP.
+        self.multicast_sender.send_frame(MESSAGE_HEADER.pack(msg_type, len(body)) + body)
+        return frame.seq
+
+    async def _record_loop(self):
+        """Taps the recording rendition like a student would: a slow disk only means frames are merged, never waited for."""
+        loop = asyncio.get_running_loop()
+        rendition, last_seq = self.record_rendition, 0
+        try:
+            while True:
+                await self.resumed.wait() # Pausing the stream pauses the recording too
+                frame_published = self.frame_published
+                if rendition.frame_buffer.seq <= last_seq:
+                    try:
+                        await asyncio.wait_for(frame_published.wait(), 0.5)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                last_seq = await loop.run_in_executor(self.record_executor, self._record_frame, rendition, last_seq)
+        except OSError as e:
+            print(f"Warning: Recording stopped ({e}).")
+            self.app.update_status(f"Recording stopped: {e}")
+
+    def _record_frame(self, rendition, since_seq):
+        """Runs on the record executor: appends the encoded message, reusing the tiles the rendition already holds."""
+        frame, msg_type, body, is_keyframe = self._shared_message(rendition, since_seq)
+        if not self.recorder.append(msg_type, body, frame.captured_at, is_keyframe):
+            rendition.request_keyframe() # Segments open with one
+        return frame.seq
+
+    def _request_keyframe(self, session):
+        """A student lost sync: unicast clients are simply caught up from scratch; the broadcast gets a rate-limited keyframe."""
+        if not session.multicast:
+            session.sent_seq = 0
+        elif self.broadcast_rendition and time.time() - self.last_keyframe_request >= KEYFRAME_REQUEST_MIN_INTERVAL:
+            self.last_keyframe_request = time.time()
+            self.broadcast_rendition.request_keyframe()
+
+    def _build_payload(self, session, rendition):
+        """Runs on the payload executor: catches the client up from what it has actually received.
+
+        Returns (frame, message type, body). v1 students always get a whole stamped JPEG, even in delta mode.
+        Relays get the shared pixels unstamped (see _send_relay_watermarks).
+        """
+        if session.relay_port:
+            return self._shared_message(rendition, session.sent_seq)[:3]
+        if not self.delta_mode or session.version < 2:
+            frame = rendition.frame_buffer.frame
+            with session.timings.measure("watermark"):
+                stamped = session.watermark.stamp_frame(frame, rendition.codec)
+            if session.version < 2:
+                return frame, MSG_FRAME, add_frame_info(stamped, frame.seq, frame.captured_at)
+            return frame, MSG_FRAME, pack_frame(frame, rendition.codec, stamped)
+        frame, is_keyframe, tiles = rendition.frame_buffer.collect_tiles(session.sent_seq)
+        with session.timings.measure("watermark"):
+            band_tile = session.watermark.band_tile(frame, tiles, force=is_keyframe, codec=rendition.codec)
+        if band_tile is not None:
+            tiles = tiles + [band_tile]
+        return frame, MSG_TILES, pack_tile_frame(frame.seq, frame.image.size, tiles, keyframe=is_keyframe, captured_at=frame.captured_at)
+
+    async def _read_client_messages(self, session, reader):
+        """Reads the small upstream messages (frame acks) a student sends back while frames stream out."""
+        try:
+            while True:
+                kind, value = CLIENT_MESSAGE.unpack(await reader.readexactly(CLIENT_MESSAGE.size))
+                if kind == CLIENT_MSG_ACK:
+                    session.controller.on_ack(value)
+                elif kind == CLIENT_MSG_KEYFRAME:
+                    self._request_keyframe(session)
+                elif kind == CLIENT_MSG_HELLO:
+                    break # Only valid as the very first message
+                elif kind == CLIENT_MSG_STATS:
+                    if value != STUDENT_STATS.size:
+                        break # Unknown report layout; the stream can't be resynchronised
+                    session.on_student_stats(STUDENT_STATS.unpack(await reader.readexactly(value)))
+                elif kind == CLIENT_MSG_ROSTER:
+                    if not ROSTER.size <= value <= ROSTER.size + RELAY_MAX_CAPACITY * ROSTER_ENTRY.size:
+                        break
+                    roster = await reader.readexactly(value) # Consumed even when ignored, or the next header would be read from it
+                    if not session.relay_port:
+                        continue # Only relays have viewers to report
+                    joined, left = session.set_roster(*unpack_roster(roster))
+                    for address in joined:
+                        print(f"[RELAY] {address} is watching through {session.address}")
+                        self.roster.add(address, relay=session.address)
+                    for address in left:
+                        self.roster.remove(address)
+                elif kind == CLIENT_MSG_VIEWPORT:
+                    if value != VIEWPORT.size:
+                        break
+                    session.set_viewer_size(*VIEWPORT.unpack(await reader.readexactly(value))) # Picked up by the stream loop
+                elif kind == CLIENT_MSG_MULTICAST and self.multicast_enabled:
+                    session.multicast = bool(value)
+                    session.sent_seq = 0
+                    session.watermark.invalidate()
+                    print(f"[MULTICAST] {session.address} {'joined the group' if value else 'fell back to TCP'}")
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+
+    def _rendition_key(self, session):
+        """(quality, scale, codec) the client should be watching: its adaptive level, capped at its window's size bucket."""
+        codec = session.codec
+        if not self.delta_mode and session.codecs & CODEC_JPEG:
+            # Only a JPEG frame is encoded once and has each viewer's band spliced in; any other codec would mean
+            # stamping and encoding the whole frame once per viewer.
+            codec = CODEC_JPEG
+        return session.controller.quality, min(session.controller.scale, session.max_scale(self.screen_size)), codec
 
-    def _listen_for_clients(self):
-        while self.is_running:
+    def _switch_rendition(self, session):
+        if session.rendition is not None:
+            self._release_rendition(session.rendition)
+        session.rendition = self._acquire_rendition(*self._rendition_key(session))
+        session.sent_seq = 0 # A new rendition has its own sequence numbers; start from its keyframe
+
+    def _apply_lag_policy(self, session):
+        """Downgrades clients that keep falling behind, and disconnects those that can't keep up even at the bottom."""
+        if session.behind_since is None:
+            return True
+        behind_for = time.time() - session.behind_since
+        if behind_for >= LAG_DOWNGRADE_AFTER and session.controller.force_downgrade():
+            print(f"[LAGGING] {session.address} fell behind for {behind_for:.0f}s; lowering quality.")
+            session.behind_since = time.time()
+            self._switch_rendition(session)
+        elif behind_for >= LAG_DISCONNECT_AFTER:
+            session.close_reason = "could not keep up at the lowest quality"
+            return False
+        return True
+
+    async def _wait_for_window(self, session):
+        """Waits until the client's link has room for another frame; returns True if it had to wait."""
+        controller = session.controller
+        waited = False
+        while not controller.has_window(session.send_backlog()):
+            waited = True
+            controller.window_opened.clear()
             try:
-                connection, address = self.server_socket.accept()
-                if not self.is_running: break
-
-                client_address_str = f"{address[0]}:{address[1]}"
-                with self.clients_lock:
-                    self.clients[client_address_str] = connection
-                
-                self.app.add_client_to_list(client_address_str)
-                
-                client_thread = threading.Thread(target=self._handle_client, args=(connection, client_address_str))
-                client_thread.daemon = True
-                client_thread.start()
-            except OSError:
-                if self.is_running: print("Error: Server socket closed unexpectedly.")
-                break
-
-    def _handle_client(self, connection, address_str):
+                await asyncio.wait_for(controller.window_opened.wait(), 0.05 if not controller.acks_supported else 0.5)
+            except asyncio.TimeoutError:
+                pass
+        return waited
+
+    async def _handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        address_str = f"{address[0]}:{address[1]}"
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH, low=WRITE_BUFFER_LOW)
+        session = ClientSession(writer, address_str, self.quality_profile, self.watermarker)
+        session.task = asyncio.current_task()
+        with self.clients_lock:
+            self.clients[address_str] = session
+        self.roster.add(address_str, session=session)
         print(f"[CONNECTED] {address_str}")
+
+        reader_task = cursor_task = None
         try:
-            with mss.mss() as sct:
-                monitor = sct.monitors[1]
-                while True:
-                    with self.clients_lock:
-                        if not self.is_running or address_str not in self.clients:
-                            break
-                    
-                    if self.is_paused:
-                        time.sleep(0.5)
-                        continue
-
-                    img = sct.grab(monitor)
-                    pil_img = Image.frombytes("RGB", img.size, img.bgra, "raw", "BGRX")
-                    
-                    draw = ImageDraw.Draw(pil_img, "RGBA")
-                    try:
-                        font_size = max(12, int(pil_img.height * 0.03))
-                        font = ImageFont.truetype(WATERMARK_FONT_PATH, font_size)
-                    except IOError:
-                        font = ImageFont.load_default()
-                        print(f"Warning: Could not load '{WATERMARK_FONT_PATH}'. Using default font.")
-                    
-                    watermark_text = f"VIEWER: {address_str.split(':')[0]} | {time.strftime('%Y-%m-%d %H:%M:%S')}"
-                    draw.text((15, 15), watermark_text, font=font, fill=(255, 255, 255, 128))
-                    
-                    with io.BytesIO() as mem_file:
-                        quality = self.quality_profile['quality']
-                        pil_img.save(mem_file, 'JPEG', quality=quality)
-                        image_bytes = mem_file.getvalue()
-
-                    connection.sendall(struct.pack(">Q", len(image_bytes)))
-                    connection.sendall(image_bytes)
-                    time.sleep(self.quality_profile['delay'])
-        except (ConnectionError, OSError) as e:
-            print(f"[DISCONNECTED] {address_str} (Reason: {e})")
+            if not await self._handshake(session, reader):
+                return
+            self.roster.set_state(address_str, ROSTER_WATCHING)
+            self._switch_rendition(session)
+            reader_task = asyncio.get_running_loop().create_task(self._read_client_messages(session, reader))
+            if session.version >= 3:
+                cursor_task = asyncio.get_running_loop().create_task(self._stream_cursor(session))
+            await self._stream_to_client(session, reader_task)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+            session.close_reason = e
+        except asyncio.CancelledError:
+            session.close_reason = session.close_reason or "server stopped"
         finally:
-            connection.close()
+            for task in (reader_task, cursor_task):
+                if task:
+                    task.cancel()
+            if session.rendition:
+                self._release_rendition(session.rendition)
+            writer.close()
             with self.clients_lock:
-                if address_str in self.clients:
+                if self.clients.get(address_str) is session:
                     del self.clients[address_str]
-            self.app.remove_client_from_list(address_str)
+            for address in session.downstream: # The relay's viewers lost their stream with it and rejoin us, to be served or sent to another relay
+                self.roster.remove(address)
+            self.roster.remove(address_str)
+            print(f"[DISCONNECTED] {address_str} (Reason: {session.close_reason})")
+
+    async def _handshake(self, session, reader):
+        """Waits briefly for a v2 hello; a student that stays silent is an original v1 client.
+
+        Returns False when the student was redirected to a relay instead of being streamed to.
+        """
+        try:
+            header = await asyncio.wait_for(reader.readexactly(CLIENT_MESSAGE.size), HELLO_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"[PROTOCOL] {session.address} sent no hello; streaming v1 (plain JPEG).")
+            return True
+        kind, size = CLIENT_MESSAGE.unpack(header)
+        if kind != CLIENT_MSG_HELLO or size != HELLO.size:
+            raise ConnectionError("unexpected handshake")
+        session.apply_hello(HELLO.unpack(await reader.readexactly(size)))
+        relay = None if session.relay_port else self._pick_relay()
+        if relay:
+            relay.pending_joins += 1
+            relay_ip = relay.address.rsplit(':', 1)[0]
+            session.writer.write(MESSAGE_HEADER.pack(MSG_REDIRECT, REDIRECT.size) + REDIRECT.pack(socket.inet_aton(relay_ip), relay.relay_port))
+            await session.writer.drain()
+            session.close_reason = f"redirected to relay {relay_ip}:{relay.relay_port}"
+            return False
+        # Written directly: the welcome is part of the handshake and, unlike every later message, never acked.
+        session.writer.write(MESSAGE_HEADER.pack(MSG_WELCOME, WELCOME.size) + WELCOME.pack(session.version, TEACHER_CODECS))
+        await session.writer.drain()
+        if session.relay_port:
+            print(f"[RELAY] {session.address} offers to relay on port {session.relay_port}")
+        return True
+
+    def _pick_relay(self):
+        """The least-loaded relay with room, once the teacher already serves RELAY_DIRECT_LIMIT viewers itself."""
+        with self.clients_lock:
+            sessions = list(self.clients.values())
+        if sum(1 for session in sessions if not session.relay_port) <= RELAY_DIRECT_LIMIT: # Includes the joiner itself
+            return None
+        relays = [session for session in sessions if session.relay_port and session.relay_load() < 1.0]
+        return min(relays, key=ClientSession.relay_load, default=None)
+
+    async def _write_message(self, session, msg_type, body, captured_at=None):
+        """Writes one message, framed for the student's protocol; every message counts towards its acks."""
+        start = time.perf_counter()
+        if session.version < 2:
+            header = struct.pack(">Q", len(body)) # v1 has a single message type: a JPEG frame
+        else:
+            header = MESSAGE_HEADER.pack(msg_type, len(body))
+        session.writer.write(header)
+        session.writer.write(body)
+        session.controller.on_send(len(header) + len(body), captured_at)
+        if session.writer.transport.get_write_buffer_size() > WRITE_BUFFER_HIGH:
+            session.mark_behind()
+        await session.writer.drain()
+        session.timings.add("send", time.perf_counter() - start)
+
+    async def _send_multicast_watermark(self, session):
+        """Multicast viewers get pixels from the group; over TCP they only receive their own watermark metadata."""
+        frame = self.broadcast_rendition.frame_buffer.frame
+        if frame is not None and session.watermark.is_stale():
+            await self._write_message(session, MSG_WATERMARK, session.watermark.metadata(frame.image.size))
+        await asyncio.sleep(0.25)
+
+    async def _send_relay_watermarks(self, session):
+        """Relays get unstamped frames, so the relay and each of its viewers are sent their own watermark as metadata.
+
+        The relay burns each viewer's watermark into the frames it forwards to that viewer, and draws its own.
+        """
+        frame = session.rendition.frame_buffer.frame
+        if frame is None:
+            return
+        if session.watermark.is_stale():
+            await self._write_message(session, MSG_WATERMARK, session.watermark.metadata(frame.image.size))
+        for address, watermark in list(session.downstream.items()):
+            if watermark.is_stale():
+                await self._write_message(session, MSG_RELAY_WATERMARK, pack_roster_entry(address) + watermark.metadata(frame.image.size))
+
+    def _cursor_message(self):
+        """The pointer as a CURSOR body, relative to the grabbed area; hidden while it is outside it."""
+        x, y, shape = self.pointer
+        if self.capture_region is None:
+            return CURSOR.pack(0, 0, CURSOR_HIDDEN)
+        left, top, width, height = self.capture_region
+        if not (left <= x < left + width and top <= y < top + height):
+            shape = CURSOR_HIDDEN
+        x, y = min(max(x - left, 0), width - 1), min(max(y - top, 0), height - 1)
+        return CURSOR.pack(x * 0xFFFF // max(1, width - 1), y * 0xFFFF // max(1, height - 1), shape)
+
+    async def _stream_cursor(self, session):
+        """Sends one v3 student every pointer move, at most every CURSOR_MIN_INTERVAL, beside the frame stream.
+
+        Written straight to the transport and never counted as a frame, so it neither waits for the frame window
+        nor uses it up; only a badly backed-up link skips moves, and the next one catches it up.
+        """
+        sent = CURSOR.pack(0, 0, CURSOR_HIDDEN) # What a student shows before its first update
+        while True:
+            await self.resumed.wait()
+            pointer_changed = self.pointer_changed
+            message = self._cursor_message()
+            if message != sent and session.writer.transport.get_write_buffer_size() <= WRITE_BUFFER_HIGH:
+                session.writer.write(MESSAGE_HEADER.pack(MSG_CURSOR, CURSOR.size) + message)
+                sent = message
+                await asyncio.sleep(CURSOR_MIN_INTERVAL)
+                continue
+            try:
+                await asyncio.wait_for(pointer_changed.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass # The capture area may have moved under a still pointer
+
+    async def _stream_to_client(self, session, reader_task):
+        """Sends one client the newest frame of its rendition whenever its link and frame interval allow.
+
+        Nothing is ever queued per client: a payload is only built once the previous one has drained, so
+        frames published meanwhile are superseded (latest frame wins) and a slow link never stalls anyone else.
+        """
+        loop = asyncio.get_running_loop()
+        next_send, next_stats = 0, 0
+        if self.multicast_enabled and session.version >= 2 and session.codecs & CODEC_JPEG and not session.relay_port:
+            await self._write_message(session, MSG_MULTICAST_ANNOUNCE, self.multicast_sender.announcement())
+        while not reader_task.done():
+            await self.resumed.wait()
+            if time.time() >= next_stats:
+                next_stats = time.time() + 1.0
+                stats = session.stats()
+                stats["stages"] = dict(self.stage_timings.snapshot(), **stats["stages"])
+                stats["capture_interval"] = self.capture_scheduler.interval
+                self.roster.update_stats(session.address, stats)
+                log_metrics(self.metrics_log, dict(stats, student_address=session.address))
+            if session.multicast:
+                if session.rendition is not None: # Pixels come from the group; stop encoding a unicast copy nobody reads
+                    self._release_rendition(session.rendition)
+                    session.rendition = None
+                await self._send_multicast_watermark(session)
+                continue
+            session.controller.update(session.send_backlog(), session.over_decode_budget())
+            rendition = session.rendition
+            if rendition is None or (rendition.quality, rendition.scale, rendition.codec) != self._rendition_key(session):
+                self._switch_rendition(session) # New level, a resized window, or the screen size just became known
+            if not self._apply_lag_policy(session):
+                return
+            if session.relay_port:
+                await self._send_relay_watermarks(session)
+
+            await asyncio.sleep(max(0, next_send - time.time()))
+            link_was_full = await self._wait_for_window(session)
+
+            rendition = session.rendition
+            frame_published = self.frame_published
+            if rendition.frame_buffer.seq <= session.sent_seq:
+                # A static screen publishes nothing, but the watermark clock still has to tick: in delta mode only
+                # the band is re-sent, otherwise the last frame is re-stamped, which also keeps the link alive.
+                if not (session.sent_seq and session.watermark.is_stale()):
+                    try:
+                        await asyncio.wait_for(frame_published.wait(), 0.5)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+            frame, msg_type, body = await loop.run_in_executor(self.payload_executor, self._build_payload, session, rendition)
+            if rendition is not session.rendition:
+                continue
+            missed = max(0, frame.seq - session.sent_seq - 1) if session.sent_seq else 0
+            if link_was_full:
+                session.frames_dropped += missed
+                session.mark_behind()
+            else:
+                session.frames_skipped += missed
+                session.behind_since = None
+            # A watermark-only refresh re-sends an old frame; its capture time would only inflate the latency figures.
+            captured_at = frame.captured_at if frame.seq > session.sent_seq else None
+            session.sent_seq = frame.seq
+            await self._write_message(session, msg_type, body, captured_at)
+            next_send = time.time() + session.controller.frame_interval
+        session.close_reason = session.close_reason or "connection closed by student"
 
 class TeacherApp:
     """Manages the entire graphical user interface and user interactions."""
     def __init__(self, window):
         self.window = window
         self.server = ScreenSharingServer(self)
+        self.roster_rows = {} # address -> (parent address or "", column texts, sort values, filter text)
+        self.roster_sort = ("student", False) # column, descending
         self._setup_window()
         self._setup_styles()
         self._create_widgets()
+        self.window.after(ROSTER_REFRESH_MS, self._refresh_roster)
         
     def _setup_window(self):
         self.window.title(f"{APP_NAME} v{APP_VERSION}")
-        self.window.geometry("600x600")
+        self.window.geometry("600x680")
         self.window.configure(bg=COLOR_BACKGROUND)
         self.window.protocol("WM_DELETE_WINDOW", self._on_closing)
         try:
@@ -207,6 +1953,8 @@ class TeacherApp:
         style.configure("Stop.TButton", font=(FONT_PRIMARY, 10, "bold"), foreground="white", background="#d32f2f")
         style.map("Stop.TButton", background=[("active", "#ef5350")])
         style.configure("Status.TLabel", background="#333333", foreground="white", padding=5, font=(FONT_PRIMARY, 9))
+        style.configure("Treeview", background=COLOR_FRAME_BG, fieldbackground=COLOR_FRAME_BG, font=("Courier New", 10), rowheight=22)
+        style.configure("Treeview.Heading", font=(FONT_PRIMARY, 9, "bold"), foreground=COLOR_TEXT_DARK)
 
     def _create_widgets(self):
         header = ttk.Frame(self.window, padding=10)
@@ -228,56 +1976,261 @@ class TeacherApp:
         self.quality_menu = ttk.OptionMenu(controls_frame, self.quality_var, None, *QUALITY_SETTINGS.keys())
         self.quality_menu.grid(row=0, column=1, columnspan=2, padx=5, pady=10, sticky="ew")
 
+        # Unlike the options below, what is shared can be changed at any time, even mid-session.
+        ttk.Label(controls_frame, text="Share:", font=(FONT_PRIMARY, 10)).grid(row=1, column=0, padx=(0, 10), pady=(0, 10), sticky="w")
+        self.capture_var = tk.StringVar()
+        self.capture_menu = ttk.Combobox(controls_frame, textvariable=self.capture_var, state="readonly")
+        self.capture_menu.grid(row=1, column=1, columnspan=2, padx=5, pady=(0, 10), sticky="ew")
+        self.capture_menu.bind("<<ComboboxSelected>>", self._on_capture_target_selected)
+        self._refresh_capture_targets()
+
+        self.delta_var = tk.BooleanVar(value=True)
+        self.delta_check = ttk.Checkbutton(controls_frame, text="Send only changed screen regions (delta mode)", variable=self.delta_var)
+        self.delta_check.grid(row=2, column=0, columnspan=3, pady=(0, 5), sticky="w")
+        self.multicast_var = tk.BooleanVar(value=False)
+        self.multicast_check = ttk.Checkbutton(controls_frame, text="Broadcast via multicast (one stream for the whole room)", variable=self.multicast_var)
+        self.multicast_check.grid(row=3, column=0, columnspan=3, pady=(0, 5), sticky="w")
+        self.record_var = tk.BooleanVar(value=False)
+        self.record_check = ttk.Checkbutton(controls_frame, text=f"Record this session (to '{RECORD_DIR}')", variable=self.record_var)
+        self.record_check.grid(row=4, column=0, columnspan=3, pady=(0, 5), sticky="w")
+
         self.start_button = ttk.Button(controls_frame, text="Start Sharing", command=self._start_server, style="Accent.TButton", width=15)
-        self.start_button.grid(row=1, column=0, padx=(0, 5), pady=10)
+        self.start_button.grid(row=5, column=0, padx=(0, 5), pady=10)
         self.stop_button = ttk.Button(controls_frame, text="Stop Sharing", command=self._stop_server, style="Stop.TButton", state=tk.DISABLED, width=15)
-        self.stop_button.grid(row=1, column=1, padx=5, pady=10)
+        self.stop_button.grid(row=5, column=1, padx=5, pady=10)
         self.pause_button = ttk.Button(controls_frame, text="Pause Stream", command=self._toggle_pause, state=tk.DISABLED, width=15)
-        self.pause_button.grid(row=1, column=2, padx=(5, 0), pady=10)
+        self.pause_button.grid(row=5, column=2, padx=(5, 0), pady=10)
 
         clients_frame = ttk.LabelFrame(main_frame, text="Student Management", padding=15)
         clients_frame.pack(fill=tk.BOTH, expand=True, pady=20)
-        clients_frame.rowconfigure(0, weight=1)
+        clients_frame.rowconfigure(1, weight=1)
         clients_frame.columnconfigure(0, weight=1)
-        
-        self.client_listbox = Listbox(clients_frame, font=("Courier New", 10), height=8, bg=COLOR_FRAME_BG, relief=tk.FLAT, highlightthickness=1, highlightbackground="#cccccc")
-        self.client_listbox.grid(row=0, column=0, sticky="nsew")
-        self.client_listbox.bind("<<ListboxSelect>>", self._on_client_select)
+
+        filter_frame = ttk.Frame(clients_frame, style="TFrame")
+        filter_frame.grid(row=0, column=0, sticky="ew", pady=(0, 10))
+        ttk.Label(filter_frame, text="Filter:").pack(side=tk.LEFT, padx=(0, 10))
+        self.filter_var = tk.StringVar()
+        self.filter_var.trace_add("write", lambda *_: self._render_roster())
+        ttk.Entry(filter_frame, textvariable=self.filter_var).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.roster_count_var = tk.StringVar(value="0 students")
+        ttk.Label(filter_frame, textvariable=self.roster_count_var).pack(side=tk.LEFT, padx=(10, 0))
+
+        self.client_tree = ttk.Treeview(clients_frame, columns=CLIENT_COLUMNS, show="headings", height=8, selectmode="extended")
+        for column, (heading, width) in CLIENT_COLUMNS.items():
+            self.client_tree.heading(column, text=heading, command=lambda column=column: self._sort_roster(column))
+            self.client_tree.column(column, width=width, anchor="w" if column == "student" else "center", stretch=column == "student")
+        self.client_tree.grid(row=1, column=0, sticky="nsew")
+        self.client_tree.bind("<<TreeviewSelect>>", self._on_client_select)
+        self.client_tree.bind("<Control-a>", lambda event: self.client_tree.selection_set(list(self._shown_rows())))
 
         kick_button_frame = ttk.Frame(clients_frame, style="TFrame", padding=(10,0))
-        kick_button_frame.grid(row=0, column=1, sticky="ns")
-        self.kick_button = ttk.Button(kick_button_frame, text="Kick Student", command=self._kick_selected_client, state=tk.DISABLED)
-        self.kick_button.pack(anchor="center")
+        kick_button_frame.grid(row=1, column=1, sticky="ns")
+        self.kick_button = ttk.Button(kick_button_frame, text="Kick Selected", command=self._kick_selected_clients, state=tk.DISABLED)
+        self.kick_button.pack(anchor="center", pady=(0, 5))
+        self.downgrade_button = ttk.Button(kick_button_frame, text="Lower Quality", command=self._downgrade_selected_clients, state=tk.DISABLED)
+        self.downgrade_button.pack(anchor="center")
         
         self.status_var = tk.StringVar(value=f"Ready. Your IP is {get_local_ip()}")
         ttk.Label(self.window, textvariable=self.status_var, style="Status.TLabel").pack(side=tk.BOTTOM, fill=tk.X)
 
+    # --- Capture Target ---
+    def _refresh_capture_targets(self):
+        """Lists every monitor (mss numbers the primary 1) plus the ways to pick a region."""
+        try:
+            monitors = list_monitors()
+        except Exception as e:
+            print(f"Warning: Could not list monitors ({e}).")
+            monitors = []
+        self.primary_region = monitors[1] if len(monitors) > 1 else (0, 0, self.window.winfo_screenwidth(), self.window.winfo_screenheight())
+        self.capture_targets = {}
+        for index, region in enumerate(monitors[1:], 1):
+            self.capture_targets[f"Monitor {index}{' (primary)' if index == 1 else ''}: {region[2]}x{region[3]}"] = None if index == 1 else region
+        if len(monitors) > 2:
+            self.capture_targets[f"All monitors: {monitors[0][2]}x{monitors[0][3]}"] = monitors[0]
+        self.capture_menu.config(values=list(self.capture_targets) + [CAPTURE_CHOICE_DRAG, CAPTURE_CHOICE_FIXED])
+        self.capture_var.set(next(iter(self.capture_targets), "Primary monitor"))
+        self.capture_choice = self.capture_var.get()
+
+    def _on_capture_target_selected(self, event=None):
+        choice = self.capture_var.get()
+        if choice == CAPTURE_CHOICE_DRAG:
+            self.capture_var.set(self.capture_choice) # Until a region has actually been dragged
+            self.window.after(100, self._drag_capture_region) # Let the dropdown close first
+        elif choice == CAPTURE_CHOICE_FIXED:
+            self.capture_var.set(self.capture_choice)
+            current = self.server.capture_target or self.primary_region
+            text = simpledialog.askstring("Fixed Region", "Region to share, in screen pixels:\nleft, top, width, height",
+                                          initialvalue=", ".join(str(value) for value in current), parent=self.window)
+            if text is not None:
+                try:
+                    self._set_capture_region(parse_region(text))
+                except ValueError as e:
+                    messagebox.showerror("Invalid Region", f"'{text}' is not a valid region: {e}.")
+        else:
+            self._set_capture_target(choice, self.capture_targets.get(choice))
+
+    def _set_capture_target(self, name, region):
+        self.capture_var.set(name)
+        self.capture_choice = name
+        self.server.set_capture_target(region)
+        if self.server.is_running:
+            self.update_status(f"Now sharing {name}.")
+
+    def _set_capture_region(self, region):
+        left, top, width, height = region
+        self._set_capture_target(f"Region: {width}x{height} at {left},{top}", region)
+
+    def _drag_capture_region(self):
+        """Covers every monitor with a dimmed overlay on which the teacher drags out the region to share."""
+        try:
+            bounds = list_monitors()[0]
+        except Exception:
+            bounds = (0, 0, self.window.winfo_screenwidth(), self.window.winfo_screenheight())
+        overlay = tk.Toplevel(self.window)
+        overlay.overrideredirect(True)
+        overlay.geometry(f"{bounds[2]}x{bounds[3]}{bounds[0]:+d}{bounds[1]:+d}")
+        overlay.attributes("-topmost", True)
+        try:
+            overlay.attributes("-alpha", 0.3)
+        except tk.TclError:
+            pass # No compositing; the overlay is simply opaque
+        canvas = tk.Canvas(overlay, background="black", cursor="crosshair", highlightthickness=0)
+        canvas.pack(fill=tk.BOTH, expand=True)
+        canvas.create_text(bounds[2] // 2, 40, text="Drag to select the region to share. Esc cancels.", fill="white", font=(FONT_PRIMARY, 16, "bold"))
+        rectangle = canvas.create_rectangle(0, 0, 0, 0, outline=COLOR_PRIMARY_ORANGE, width=3)
+        start = {}
+
+        def on_press(event):
+            start["x"], start["y"] = event.x_root, event.y_root
+        def on_drag(event):
+            if start:
+                canvas.coords(rectangle, start["x"] - bounds[0], start["y"] - bounds[1], event.x_root - bounds[0], event.y_root - bounds[1])
+        def on_release(event):
+            if not start:
+                return
+            overlay.destroy()
+            left, top = min(start["x"], event.x_root), min(start["y"], event.y_root)
+            width, height = abs(event.x_root - start["x"]), abs(event.y_root - start["y"])
+            if min(width, height) < CAPTURE_MIN_SIZE:
+                messagebox.showwarning("Region Too Small", f"Drag out a region of at least {CAPTURE_MIN_SIZE}x{CAPTURE_MIN_SIZE} pixels.")
+                return
+            self._set_capture_region((left, top, width, height))
+
+        canvas.bind("<ButtonPress-1>", on_press)
+        canvas.bind("<B1-Motion>", on_drag)
+        canvas.bind("<ButtonRelease-1>", on_release)
+        overlay.bind("<Escape>", lambda event: overlay.destroy())
+        overlay.focus_force()
+        overlay.grab_set()
+
     def _start_server(self):
-        if self.server.start(self.quality_var.get()):
+        if self.server.start(self.quality_var.get(), self.delta_var.get(), self.multicast_var.get(), self.record_var.get()):
             self.start_button.config(state=tk.DISABLED)
             self.quality_menu.config(state=tk.DISABLED)
+            self.delta_check.config(state=tk.DISABLED)
+            self.multicast_check.config(state=tk.DISABLED)
+            self.record_check.config(state=tk.DISABLED)
             self.stop_button.config(state=tk.NORMAL)
             self.pause_button.config(state=tk.NORMAL)
+            self._poll_pointer()
+
+    def _poll_pointer(self):
+        """Samples the pointer on the Tk thread while the server runs; the server streams it to the students."""
+        if not self.server.is_running:
+            return
+        x, y = self.window.winfo_pointerxy()
+        self.server.move_pointer(x, y, pointer_shape())
+        self.window.after(CURSOR_POLL_MS, self._poll_pointer)
     
     def _stop_server(self):
         self.server.stop()
         self.start_button.config(state=tk.NORMAL)
         self.quality_menu.config(state=tk.NORMAL)
+        self.delta_check.config(state=tk.NORMAL)
+        self.multicast_check.config(state=tk.NORMAL)
+        self.record_check.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
         self.pause_button.config(state=tk.DISABLED, text="Pause Stream")
         self.kick_button.config(state=tk.DISABLED)
+        self.downgrade_button.config(state=tk.DISABLED)
 
     def _toggle_pause(self):
         is_paused = self.server.toggle_pause()
         self.pause_button.config(text="Resume Stream" if is_paused else "Pause Stream")
 
-    def _kick_selected_client(self):
-        if not self.client_listbox.curselection(): return
-        client_address = self.client_listbox.get(self.client_listbox.curselection()[0])
-        self.server.kick_client(client_address)
+    def _kick_selected_clients(self):
+        selection = self.client_tree.selection()
+        if len(selection) > 1 and not messagebox.askyesno("Confirm Kick", f"Disconnect {len(selection)} students?"):
+            return
+        self.server.kick_clients(selection)
+
+    def _downgrade_selected_clients(self):
+        count = self.server.downgrade_clients(self.client_tree.selection())
+        self.update_status(f"Lowered the stream quality for {count} student(s).")
 
     def _on_client_select(self, event):
-        self.kick_button.config(state=tk.NORMAL if self.client_listbox.curselection() else tk.DISABLED)
+        state = tk.NORMAL if self.client_tree.selection() else tk.DISABLED
+        self.kick_button.config(state=state)
+        self.downgrade_button.config(state=state)
+
+    # --- Student Roster ---
+    def _refresh_roster(self):
+        """Applies everything that changed in the server's roster since the last refresh, then re-arms itself."""
+        changed = self.server.roster.drain()
+        for address, entry in changed.items():
+            if entry is None:
+                self.roster_rows.pop(address, None)
+            else:
+                texts, sort_values = roster_row(entry)
+                filter_text = " ".join(str(text) for text in texts + (entry.state,)).lower()
+                self.roster_rows[address] = (entry.relay or "", texts, sort_values, filter_text)
+        if changed:
+            self._render_roster()
+        self.window.after(ROSTER_REFRESH_MS, self._refresh_roster)
+
+    def _shown_rows(self):
+        """Addresses passing the filter, plus the relays they watch through so they have somewhere to hang."""
+        query = self.filter_var.get().strip().lower()
+        shown = {address for address, row in self.roster_rows.items() if query in row[3]}
+        return shown | {self.roster_rows[address][0] for address in shown if self.roster_rows[address][0] in self.roster_rows}
+
+    def _render_roster(self):
+        """Brings the tree in line with roster_rows, the filter and the sort order, touching only rows that differ."""
+        shown = self._shown_rows()
+        for address in self.client_tree.get_children():
+            for child in self.client_tree.get_children(address):
+                if child not in shown or self.roster_rows[child][0] != address:
+                    self.client_tree.delete(child)
+            if address not in shown:
+                self.client_tree.delete(address)
+        column, descending = self.roster_sort
+        index = list(CLIENT_COLUMNS).index(column)
+        order = sorted(shown, key=lambda address: self.roster_rows[address][2][index], reverse=descending)
+        children = {"": []}
+        for address in order:
+            parent = self.roster_rows[address][0]
+            parent = parent if parent in shown else "" # A viewer whose relay already left stays listed on its own
+            children.setdefault(parent, []).append(address)
+        for parent in [""] + children[""]:
+            for position, address in enumerate(children.get(parent, [])):
+                texts = self.roster_rows[address][1]
+                if not self.client_tree.exists(address):
+                    self.client_tree.insert(parent, position, iid=address, values=texts, open=True)
+                else:
+                    if tuple(map(str, self.client_tree.item(address, "values"))) != tuple(map(str, texts)):
+                        self.client_tree.item(address, values=texts)
+                    if self.client_tree.parent(address) != parent or self.client_tree.index(address) != position:
+                        self.client_tree.move(address, parent, position)
+        self.roster_count_var.set(f"{len(shown)} of {len(self.roster_rows)} students" if len(shown) < len(self.roster_rows) else f"{len(self.roster_rows)} students")
+
+    def _sort_roster(self, column):
+        """Sorts by a column; clicking the same heading again reverses the order."""
+        current, descending = self.roster_sort
+        self.roster_sort = (column, not descending if column == current else False)
+        for name, (heading, _) in CLIENT_COLUMNS.items():
+            arrow = (" ▼" if self.roster_sort[1] else " ▲") if name == column else ""
+            self.client_tree.heading(name, text=heading + arrow)
+        self._render_roster()
 
     def _on_closing(self):
         if self.server.is_running and messagebox.askyesno("Confirm Exit", "A sharing session is active. Exiting will disconnect all students.\nAre you sure you want to exit?"):
@@ -288,15 +2241,6 @@ class TeacherApp:
             
     def update_status(self, text): self.window.after(0, lambda: self.status_var.set(text))
     def show_error(self, title, msg): self.window.after(0, lambda: messagebox.showerror(title, msg))
-    def add_client_to_list(self, addr): self.window.after(0, lambda: self.client_listbox.insert(END, addr))
-    def clear_client_list(self): self.window.after(0, lambda: self.client_listbox.delete(0, END))
-    def remove_client_from_list(self, addr):
-        def _remove():
-            try:
-                items = self.client_listbox.get(0, END)
-                self.client_listbox.delete(items.index(addr))
-            except (ValueError, tk.TclError): pass
-        self.window.after(0, _remove)
 
 def get_local_ip():
     """Finds the local IP address of the machine."""